@@ -0,0 +1,269 @@
+"""水印函数基准测试
+
+用法：
+    python bench_watermark.py                      # 跑全部用例并打印结果
+    python bench_watermark.py --quick              # 只跑小尺寸，几秒钟出结果
+    python bench_watermark.py --save-baseline      # 把结果存成基线（bench_baseline.json）
+    python bench_watermark.py --compare            # 和基线对比，变慢/变胖超过阈值时退出码为 1
+
+每个用例在单独的子进程里跑，峰值 RSS 互不干扰；RSS 增量是计时期间后台线程
+从 /proc/self/statm 采到的最高常驻内存减去开跑前的常驻内存。
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import ctypes
+import resource
+import threading
+import tracemalloc
+import multiprocessing
+
+# 导入 bot.py 时会初始化数据库，先指到临时目录
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_watermark_"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot  # noqa: E402
+from PIL import Image  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+TRACKING_CODE = "BENCH001"
+
+# 图片边长（8K 按 7680x4320 算）和 JSON 大小
+IMAGE_SIZES = {"256": (256, 256), "1K": (1024, 1024), "2K": (2048, 2048), "4K": (3840, 2160), "8K": (7680, 4320)}
+JSON_SIZES = {"1KB": 1 << 10, "100KB": 100 << 10, "1MB": 1 << 20, "5MB": 5 << 20, "20MB": 20 << 20}
+QUICK_IMAGE_SIZES = ("256", "1K")
+QUICK_JSON_SIZES = ("1KB", "100KB")
+
+# ============ 生成测试数据 ============
+
+def make_image(kind, size):
+    """生成带渐变和噪点的图片，kind 为 png / rgba / jpeg"""
+    width, height = size
+    noise = Image.effect_noise(size, 40)
+    gradient = Image.linear_gradient("L").resize(size)
+    channels = [noise, gradient, Image.blend(noise, gradient, 0.5)]
+    if kind == "rgba":
+        img = Image.merge("RGBA", channels + [gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)])
+    else:
+        img = Image.merge("RGB", channels)
+    output = io.BytesIO()
+    if kind == "jpeg":
+        img.save(output, format="JPEG", quality=95)
+    else:
+        img.save(output, format="PNG", compress_level=1)
+    return output.getvalue()
+
+def make_card(target_bytes):
+    """生成接近目标大小的角色卡 JSON（世界书条目撑大体积）"""
+    rng = random.Random(target_bytes)
+    card = {
+        "spec": "chara_card_v3",
+        "data": {
+            "name": "开心果",
+            "description": "雪山里的外星企鹅",
+            "extensions": {"depth_prompt": {"depth": 4, "prompt": ""}},
+            "character_book": {"entries": []},
+        },
+    }
+    raw = json.dumps(card, ensure_ascii=False, indent=2).encode("utf-8")
+    entries = card["data"]["character_book"]["entries"]
+    entry_size = 600
+    while len(raw) + len(entries) * entry_size < target_bytes:
+        entries.append({
+            "keys": [f"关键词{rng.randrange(10000)}"],
+            "content": "".join(rng.choice("冰雪甜品雪山企鹅abcdefg ") for _ in range(120)),
+            "extensions": {"position": rng.randrange(5)},
+        })
+        if len(entries) % 256 == 0:
+            raw = json.dumps(card, ensure_ascii=False, indent=2).encode("utf-8")
+            entry_size = max(1, (len(raw) - 200) // len(entries))
+    return json.dumps(card, ensure_ascii=False, indent=2).encode("utf-8")
+
+def build_cases(quick):
+    """列出所有 (用例名, 函数名, 数据类型, 尺寸)"""
+    image_sizes = QUICK_IMAGE_SIZES if quick else tuple(IMAGE_SIZES)
+    json_sizes = QUICK_JSON_SIZES if quick else tuple(JSON_SIZES)
+    cases = []
+    for kind in ("png", "rgba", "jpeg"):
+        for size in image_sizes:
+            cases.append((f"embed_image_watermark/{kind}/{size}", "embed_image_watermark", kind, size))
+            cases.append((f"extract_image_watermark/{kind}/{size}", "extract_image_watermark", kind, size))
+            if kind != "jpeg":
+                cases.append((f"render_png_template/{kind}/{size}", "render_png_template", kind, size))
+    for size in json_sizes:
+        cases.append((f"embed_json_watermark/{size}", "embed_json_watermark", "json", size))
+        cases.append((f"extract_json_watermark/{size}", "extract_json_watermark", "json", size))
+    return cases
+
+def prepare_input(func_name, kind, size):
+    """准备被测函数的参数，返回 (参数列表, 输入字节数)"""
+    if kind == "json":
+        data = make_card(JSON_SIZES[size])
+    else:
+        data = make_image(kind, IMAGE_SIZES[size])
+    if func_name == "embed_image_watermark":
+        return (data, TRACKING_CODE), len(data)
+    if func_name == "extract_image_watermark":
+        return (bot.embed_image_watermark(data, TRACKING_CODE),), len(data)
+    if func_name == "render_png_template":
+        return (bot.build_png_template(data), TRACKING_CODE), len(data)
+    if func_name == "embed_json_watermark":
+        return (data, TRACKING_CODE), len(data)
+    return (bot.embed_json_watermark(data, TRACKING_CODE),), len(data)
+
+# ============ 测量 ============
+
+PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024
+
+def current_rss_kb():
+    """当前常驻内存（KB）；没有 /proc 的系统返回 None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_KB
+    except OSError:
+        return None
+
+def release_free_memory():
+    """让 glibc 把已经释放的堆内存还给系统，开跑前的常驻内存才不会虚高"""
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+class RssSampler(threading.Thread):
+    """计时期间每隔 1ms 读一次常驻内存，记下最高值"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = current_rss_kb() or 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(0.001):
+            self.peak = max(self.peak, current_rss_kb() or 0)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss_kb() or 0)
+        return self.peak
+
+def run_case(case, repeat, queue):
+    """在子进程里跑一个用例：先测耗时和峰值 RSS，再单独跑一次统计 Python 内存分配"""
+    name, func_name, kind, size = case
+    func = getattr(bot, func_name)
+    args, input_bytes = prepare_input(func_name, kind, size)
+    # ru_maxrss 是整个进程的历史峰值（生成输入时就可能到顶了），增量改用采样的当前常驻内存
+    release_free_memory()
+    rss_before = current_rss_kb()
+    sampler = RssSampler()
+    sampler.start()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    rss_sampled = sampler.stop()
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tracemalloc.start()
+    func(*args)
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    alloc_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+
+    timings.sort()
+    median = timings[len(timings) // 2]
+    queue.put({
+        "name": name,
+        "input_bytes": input_bytes,
+        "median_s": median,
+        "min_s": timings[0],
+        "ops_per_s": 1 / median if median else float("inf"),
+        "mb_per_s": input_bytes / 1024 / 1024 / median if median else float("inf"),
+        "rss_peak_kb": rss_peak,
+        "rss_delta_kb": max(0, rss_sampled - rss_before) if rss_before is not None else 0,
+        "alloc_peak_bytes": alloc_peak,
+        "alloc_blocks": alloc_blocks,
+    })
+
+def measure(case, repeat):
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run_case, args=(case, repeat, queue))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0 or queue.empty():
+        return {"name": case[0], "error": f"子进程退出码 {proc.exitcode}"}
+    return queue.get()
+
+# ============ 输出与对比 ============
+
+def print_results(results):
+    header = f"{'用例':<40} {'中位耗时':>10} {'吞吐 MB/s':>10} {'峰值RSS MB':>11} {'RSS增量 MB':>11} {'分配峰值 MB':>11} {'存活块':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        if "error" in r:
+            print(f"{r['name']:<40} {r['error']}")
+            continue
+        print(
+            f"{r['name']:<40} {r['median_s'] * 1000:>8.2f}ms {r['mb_per_s']:>10.1f} "
+            f"{r['rss_peak_kb'] / 1024:>11.1f} {r['rss_delta_kb'] / 1024:>11.1f} "
+            f"{r['alloc_peak_bytes'] / 1024 / 1024:>11.2f} {r['alloc_blocks']:>8}"
+        )
+
+def compare(results, baseline, threshold):
+    """和基线比较耗时与内存，返回退步的用例说明"""
+    previous = {r["name"]: r for r in baseline.get("results", []) if "error" not in r}
+    regressions = []
+    for r in results:
+        old = previous.get(r["name"])
+        if not old or "error" in r:
+            continue
+        for key, label in (("median_s", "耗时"), ("rss_delta_kb", "RSS增量"), ("alloc_peak_bytes", "分配峰值")):
+            # 太小的数值抖动大，不参与比较
+            if old[key] and r[key] > old[key] * (1 + threshold) and r[key] - old[key] > (0.002 if key == "median_s" else 1024):
+                regressions.append(f"{r['name']} {label}：{old[key]:.4g} → {r[key]:.4g}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="水印函数基准测试")
+    parser.add_argument("--quick", action="store_true", help="只跑小尺寸用例")
+    parser.add_argument("--repeat", type=int, default=5, help="每个用例重复次数（取中位数）")
+    parser.add_argument("--filter", default="", help="只跑名字包含该字符串的用例")
+    parser.add_argument("--save-baseline", nargs="?", const=BASELINE_PATH, help="把结果保存为基线")
+    parser.add_argument("--compare", nargs="?", const=BASELINE_PATH, help="和基线对比")
+    parser.add_argument("--threshold", type=float, default=0.2, help="超过基线多少比例算退步（默认 0.2）")
+    args = parser.parse_args()
+
+    cases = [case for case in build_cases(args.quick) if args.filter in case[0]]
+    results = []
+    for case in cases:
+        print(f"… {case[0]}", file=sys.stderr)
+        results.append(measure(case, args.repeat))
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "python": sys.version.split()[0], "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\n基线已保存到 {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("\n⚠️ 以下用例比基线退步了：")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\n✅ 没有超过阈值的退步")
+
+if __name__ == "__main__":
+    main()
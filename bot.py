@@ -2,12 +2,27 @@ import os
 import io
 import json
 import uuid
+import math
 import random
+import time
 import sqlite3
 import asyncio
+import threading
+import zipfile
+import multiprocessing
 import re
+import zlib
+import struct
+import base64
+import hashlib
+import signal
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
 from PIL import Image
+import aiohttp
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
@@ -27,9 +42,62 @@ PINNED_MESSAGE_GUIDE_URL = "https://raw.githubusercontent.com/CeciliaLeander/ali
 RULES_LINK = "https://discord.com/channels/1446888252194816132/1447518124696928357/1474661532779544636"
 
 # 数据存储路径
-DATA_DIR = "/data"
+DATA_DIR = os.getenv("DATA_DIR", "/data")
 FILES_DIR = os.path.join(DATA_DIR, "files")
+# 内容寻址仓库：文件按 SHA-256 存成 objects/ab/cd/<哈希><扩展名>，内容相同的版本共用一份
+BLOBS_DIR = os.path.join(FILES_DIR, "objects")
+# 上传时每次从 Discord 下载多少字节写一次盘
+INGEST_CHUNK_BYTES = 256 * 1024
+# 清理没人引用的文件时，最近多少秒内写过/用过的先不动（上传写完文件到记进数据库之间有空档）
+BLOB_GRACE_SECONDS = 3600
 DB_PATH = os.path.join(DATA_DIR, "bot.db")
+# 发给用户的水印文件先写到这里，直接从磁盘发出去，发完就删
+DELIVERY_DIR = os.path.join(DATA_DIR, "outgoing")
+
+# 预渲染副本池：统计最近多少秒的请求、最少几次请求才算热门、每个文件最多备几份、
+# 按多少秒的需求量备货、副本多久没人领就作废、所有副本总共最多占多少 MB
+PRERENDER_WINDOW = 300
+PRERENDER_MIN_REQUESTS = 3
+PRERENDER_MAX_COPIES = 8
+PRERENDER_LEAD_SECONDS = 60
+PRERENDER_TTL = 1800
+PRERENDER_BUDGET_MB = 128
+
+# 已发送文件缓存：每个人拿过的水印文件留一份，重复拿时直接发；磁盘上最多占多少 MB
+RENDERED_DIR = os.path.join(DATA_DIR, "rendered")
+RENDERED_CACHE_MB = int(os.getenv("RENDERED_CACHE_MB", "512"))
+
+# 写缓冲：攒多少毫秒或多少条写入一起提交
+WRITE_BATCH_MS = 5
+WRITE_BATCH_ROWS = 200
+
+# 批量验证：压缩包里最多处理多少个文件、单个文件最大多少 MB
+BATCH_VERIFY_MAX_FILES = 200
+BATCH_VERIFY_MAX_MB = 50
+
+# 批量上传：压缩包里最多导入多少个文件、单个文件最大多少 MB、同时解压几个
+BULK_IMPORT_MAX_FILES = 200
+BULK_IMPORT_MAX_MB = 50
+BULK_IMPORT_CONCURRENCY = 4
+
+# 帖子参与索引：后台补录历史消息时每翻一页（100 条）歇多少秒、多少分钟找一次没补完的帖子
+PARTICIPATION_CRAWL_PAUSE = 1.0
+PARTICIPATION_CRAWL_MINUTES = 10
+
+# 热门文件缓存的内存预算（MB）
+ASSET_CACHE_MB = int(os.getenv("ASSET_CACHE_MB", "256"))
+
+# 水印工作进程数、排队上限、单个任务超时（秒）
+WATERMARK_WORKERS = int(os.getenv("WATERMARK_WORKERS", str(os.cpu_count() or 1)))
+WATERMARK_QUEUE_SIZE = int(os.getenv("WATERMARK_QUEUE_SIZE", "32"))
+WATERMARK_TIMEOUT = float(os.getenv("WATERMARK_TIMEOUT", "30"))
+# 单个水印任务最多占多少 MB 内存（按图片尺寸和文件大小估算），超过的不做
+WATERMARK_JOB_MAX_MB = int(os.getenv("WATERMARK_JOB_MAX_MB", "192"))
+# /获取附件 排队：每人同时最多几个（排队的加正在做的）、正在做的任务估算内存合计上限（MB）、
+# 排队的人多久刷新一次位置（秒）
+RENDER_PER_USER = int(os.getenv("RENDER_PER_USER", "2"))
+RENDER_BUDGET_MB = int(os.getenv("RENDER_BUDGET_MB", "384"))
+RENDER_QUEUE_UPDATE_SECONDS = 2
 
 # 管理员身份组名称（拥有此身份组的人才能上传/验证）
 ADMIN_ROLE_NAMES = ["开心果bot", "见习开心果bot"]
@@ -81,10 +149,154 @@ def get_nickname_avatar_url(nickname: str) -> str:
 
 # ============ 确保目录存在 ============
 os.makedirs(FILES_DIR, exist_ok=True)
+os.makedirs(DELIVERY_DIR, exist_ok=True)
+os.makedirs(RENDERED_DIR, exist_ok=True)
+
+# 水印工作进程（forkserver）启动时会以 __mp_main__ 的名字重新导入本文件，这时不建表、不清理目录，只用里面的函数
+IN_WORKER_PROCESS = __name__ == "__mp_main__" or multiprocessing.parent_process() is not None
+
+# ============ 数据库访问层 ============
+
+class Database:
+    """全局共用的 SQLite 访问层
+
+    整个 bot 只开一个长连接（WAL 模式），所有语句都在一个专用线程上串行执行，
+    协程里 await 这里的方法就行，不会再卡住事件循环。
+
+    高频的记录型写入（追踪记录、匿名消息、抽奖报名）走写缓冲：先攒几毫秒，
+    再在一个事务里一起提交。之后发起的读会先把缓冲交给数据库线程，所以总能读到自己刚写的数据。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self.pending = []  # [(sql, params, future 或 None)]
+        self.flush_handle = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL 下 NORMAL 只在检查点时 fsync，断电最多丢最后几个事务，不会损坏数据库
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA cache_size=-16000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _run(self, func, *args):
+        """在数据库线程上执行 func(conn, *args)：成功就提交，出错就回滚"""
+        if self.conn is None:
+            self.conn = self._connect()
+        try:
+            result = func(self.conn, *args)
+            self.conn.commit()
+            return result
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+    def run_sync(self, func, *args):
+        """同步版本，只给事件循环启动前的代码用（比如建表）"""
+        return self.executor.submit(self._run, func, *args).result()
+
+    async def run(self, func, *args):
+        """把 func(conn, *args) 当作一个事务放到数据库线程上执行"""
+        self.flush()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._run, func, *args)
+
+    # ---- 写缓冲 ----
+
+    def enqueue(self, sql: str, params=()):
+        """写入缓冲，不等提交（失败只打日志）"""
+        self._append(sql, params, None)
+
+    async def write(self, sql: str, params=()):
+        """写入缓冲并等到它提交，返回游标；这条语句出错（比如重复报名）会在这里抛出"""
+        future = asyncio.get_running_loop().create_future()
+        self._append(sql, params, future)
+        return await future
+
+    def _append(self, sql, params, future):
+        self.pending.append((sql, params, future))
+        if len(self.pending) >= WRITE_BATCH_ROWS:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(WRITE_BATCH_MS / 1000, self.flush)
+
+    def flush(self):
+        """把缓冲里的写交给数据库线程（线程里按顺序执行，之后提交的读一定排在它们后面）"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return None
+        batch, self.pending = self.pending, []
+        return self.executor.submit(self._write_batch, batch)
+
+    def _write_batch(self, batch):
+        """在数据库线程上把一批写放进同一个事务提交；单条出错不影响同批其他语句"""
+        if self.conn is None:
+            self.conn = self._connect()
+        results = []
+        try:
+            for sql, params, _ in batch:
+                try:
+                    results.append((self.conn.execute(sql, params), None))
+                except sqlite3.Error as e:
+                    results.append((None, e))
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            results = [(None, e)] * len(batch)
+        for (sql, _, future), (cursor, error) in zip(batch, results):
+            if future is None:
+                if error:
+                    print(f"[数据库] 写入失败：{error}（{sql[:60]}）")
+                continue
+            loop = future.get_loop()
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(settle_future, future, cursor, error)
+
+    async def execute(self, sql: str, params=()):
+        """执行一条语句并提交，返回游标（可取 lastrowid / rowcount）"""
+        return await self.run(lambda conn: conn.execute(sql, params))
+
+    async def executemany(self, sql: str, seq_of_params):
+        return await self.run(lambda conn: conn.executemany(sql, seq_of_params))
+
+    async def fetchone(self, sql: str, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    def close(self):
+        """把缓冲里的写提交并落盘，然后关闭连接（退出前调用）"""
+        def close_conn():
+            if self.conn is not None:
+                # 检查点会 fsync，synchronous=NORMAL 下最后几个事务也能落盘
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self.conn.close()
+                self.conn = None
+        self.flush()
+        self.executor.submit(close_conn).result()
+        self.executor.shutdown()
+
+def settle_future(future, cursor, error):
+    if future.cancelled():
+        return
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(cursor)
 
-# ============ 数据库初始化 ============
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
+db = Database(DB_PATH)
+
+# ============ 数据库初始化 / 迁移 ============
+def create_tables(conn):
+    """迁移 1：建表（旧库里这些表早就有了，IF NOT EXISTS 会直接跳过）"""
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS files (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -184,10 +396,191 @@ def init_db():
         UNIQUE(guild_id, user_id, role_id)
     )''')
 
+    # ========== 预渲染副本预留的追踪码 ==========
+    c.execute('''CREATE TABLE IF NOT EXISTS tracking_reservations (
+        tracking_code TEXT PRIMARY KEY,
+        file_id INTEGER NOT NULL,
+        reserved_at TEXT NOT NULL
+    )''')
+
+def add_hot_path_indexes(conn):
+    """迁移 2：给热点查询加索引
+
+    files 按 post_name 查询直接用 UNIQUE(post_name, file_name, version) 自带的索引，不用另建；
+    lottery_entries 按 lottery_id、tracking 按 tracking_code 也同理。
+    """
+    c = conn.cursor()
+    # 查看记录：WHERE post_name = ? ORDER BY retrieved_at DESC
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tracking_post_time ON tracking (post_name, retrieved_at)")
+    # 查看匿名身份：WHERE bot_message_id = ?
+    c.execute("CREATE INDEX IF NOT EXISTS idx_anon_messages_bot_message ON anon_messages (bot_message_id)")
+    # 持久化抽奖按钮：WHERE message_id = ?
+    c.execute("CREATE INDEX IF NOT EXISTS idx_lotteries_message ON lotteries (message_id)")
+    # 恢复定时器 / 临时身份组列表：WHERE status = 'active' [AND guild_id = ?] ORDER BY expire_at
+    c.execute("CREATE INDEX IF NOT EXISTS idx_temp_roles_status ON temp_roles (status, guild_id, expire_at)")
+
+def key_files_by_thread(conn):
+    """迁移 3：files 改成按帖子 ID 归档
+
+    帖子名会被改，同名帖子也可能不止一个，所以唯一约束换成 (thread_id, file_name, version)。
+    SQLite 改不了约束，只能新建表把数据搬过去。旧数据没有记帖子 ID：
+    名字太长时存储目录本身就是帖子 ID，可以直接认领；其余的先留空，
+    启动后列出服务器里的帖子按帖子名认领（见 resolve_legacy_threads）。
+    """
+    c = conn.cursor()
+    columns = [row[1] for row in c.execute("PRAGMA table_info(files)")]
+    if "thread_id" in columns:
+        return
+    c.execute('''CREATE TABLE files_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        thread_id INTEGER,
+        post_name TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        version TEXT NOT NULL,
+        file_path TEXT NOT NULL,
+        file_type TEXT NOT NULL,
+        uploaded_by INTEGER NOT NULL,
+        uploaded_at TEXT NOT NULL,
+        UNIQUE(thread_id, file_name, version)
+    )''')
+    c.execute(
+        "INSERT INTO files_new (id, post_name, file_name, version, file_path, file_type, uploaded_by, uploaded_at) "
+        "SELECT id, post_name, file_name, version, file_path, file_type, uploaded_by, uploaded_at FROM files"
+    )
+    c.execute("DROP TABLE files")
+    c.execute("ALTER TABLE files_new RENAME TO files")
+    # 认领旧数据时按帖子名查
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_post_name ON files (post_name) WHERE thread_id IS NULL")
+
+    # 存储目录是纯数字（Discord 的 ID 至少 17 位）的就是帖子 ID
+    for file_id, file_path in c.execute("SELECT id, file_path FROM files").fetchall():
+        folder = os.path.basename(os.path.dirname(file_path))
+        if folder.isdigit() and len(folder) >= 17:
+            c.execute("UPDATE OR IGNORE files SET thread_id = ? WHERE id = ?", (int(folder), file_id))
+
+def add_content_hash(conn):
+    """迁移 4：记录文件内容哈希，并给按路径数引用的查询加索引"""
+    c = conn.cursor()
+    columns = [row[1] for row in c.execute("PRAGMA table_info(files)")]
+    if "content_hash" not in columns:
+        c.execute("ALTER TABLE files ADD COLUMN content_hash TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_path ON files (file_path)")
+
+def add_reaction_index(conn):
+    """迁移 5：首楼点赞索引
+
+    按表情分行记，同一个人点了两个表情、取消其中一个时还算点过赞。
+    reaction_backfills 记录哪些帖子已经从 Discord 补过一次历史点赞。
+    """
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS thread_reactions (
+        thread_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        emoji TEXT NOT NULL,
+        PRIMARY KEY (thread_id, user_id, emoji)
+    ) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS reaction_backfills (
+        thread_id INTEGER PRIMARY KEY,
+        completed_at TEXT NOT NULL
+    )''')
+
+def add_participation_index(conn):
+    """迁移 6：帖子参与索引
+
+    每条评论一行（消息被删时按消息 ID 删掉），按 (thread_id, user_id) 查有没有评论过。
+    participation_backfills 记录补录历史消息补到了哪条、有没有补完。
+    """
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS thread_messages (
+        message_id INTEGER PRIMARY KEY,
+        thread_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_thread_messages_thread_user ON thread_messages (thread_id, user_id)")
+    c.execute('''CREATE TABLE IF NOT EXISTS participation_backfills (
+        thread_id INTEGER PRIMARY KEY,
+        last_message_id INTEGER,
+        completed_at TEXT
+    )''')
+
+def add_tracking_user_index(conn):
+    """迁移 7：同一个人重复拿同一个文件时查他第一次拿到的追踪码"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tracking_user_file ON tracking (user_id, file_id, retrieved_at)")
+
+def add_tracking_allocator(conn):
+    """迁移 8：追踪码分配器的计数器和置换密钥（只有一行）"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS tracking_allocator (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        next_counter INTEGER NOT NULL,
+        secret BLOB NOT NULL
+    )''')
+    conn.execute("INSERT OR IGNORE INTO tracking_allocator (id, next_counter, secret) VALUES (1, 0, ?)", (os.urandom(16),))
+
+# 按版本号顺序执行，已经执行过的（记在 schema_version 里）不会再跑；只能往后追加，不要改已有的
+MIGRATIONS = [
+    (1, "建表", create_tables),
+    (2, "热点查询索引", add_hot_path_indexes),
+    (3, "附件按帖子 ID 归档", key_files_by_thread),
+    (4, "内容寻址文件仓库", add_content_hash),
+    (5, "首楼点赞索引", add_reaction_index),
+    (6, "帖子参与索引", add_participation_index),
+    (7, "按用户和文件查追踪码", add_tracking_user_index),
+    (8, "追踪码分配器", add_tracking_allocator),
+]
+
+def run_migrations(conn):
+    """把数据库升级到最新版本，每个迁移一个事务"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    )''')
     conn.commit()
-    conn.close()
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    for version, name, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute("BEGIN")
+        migrate(conn)
+        conn.execute(
+            "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+            (version, name, datetime.now().isoformat())
+        )
+        conn.commit()
+        print(f"[数据库] 已执行迁移 {version}：{name}")
+
+# 热点查询和它们应该用到的索引，启动时用 EXPLAIN QUERY PLAN 检查一遍
+HOT_QUERIES = [
+    ("files WHERE thread_id", "SELECT id, file_name, version, file_path, file_type FROM files WHERE thread_id = ? ORDER BY uploaded_at DESC", (0,), "sqlite_autoindex_files_1"),
+    ("files WHERE legacy post_name", "UPDATE OR IGNORE files SET thread_id = ? WHERE thread_id IS NULL AND post_name = ?", (0, ""), "idx_files_post_name"),
+    ("files WHERE file_path", "SELECT COUNT(*) FROM files WHERE file_path = ?", ("",), "idx_files_path"),
+    ("thread_reactions WHERE thread_id AND user_id", "SELECT 1 FROM thread_reactions WHERE thread_id = ? AND user_id = ? LIMIT 1", (0, 0), "PRIMARY KEY"),
+    ("thread_messages WHERE thread_id AND user_id", "SELECT 1 FROM thread_messages WHERE thread_id = ? AND user_id = ? LIMIT 1", (0, 0), "idx_thread_messages_thread_user"),
+    ("tracking WHERE user_id AND file_id", "SELECT tracking_code FROM tracking WHERE user_id = ? AND file_id = ? ORDER BY retrieved_at LIMIT 1", (0, 0), "idx_tracking_user_file"),
+    ("tracking WHERE post_name", "SELECT tracking_code FROM tracking WHERE post_name = ? ORDER BY retrieved_at DESC LIMIT 20", ("",), "idx_tracking_post_time"),
+    ("anon_messages WHERE bot_message_id", "SELECT user_id FROM anon_messages WHERE bot_message_id = ? AND channel_id = ?", (0, 0), "idx_anon_messages_bot_message"),
+    ("lotteries WHERE message_id", "SELECT id FROM lotteries WHERE message_id = ?", (0,), "idx_lotteries_message"),
+    ("temp_roles WHERE status", "SELECT id FROM temp_roles WHERE status = 'active'", (), "idx_temp_roles_status"),
+    ("temp_roles WHERE guild_id AND status", "SELECT id FROM temp_roles WHERE guild_id = ? AND status = 'active' ORDER BY expire_at ASC", (0,), "idx_temp_roles_status"),
+    ("temp_roles keyset page", "SELECT id FROM temp_roles WHERE guild_id = ? AND status = 'active' AND (expire_at, id) > (?, ?) ORDER BY expire_at, id LIMIT 26", (0, "", 0), "idx_temp_roles_status"),
+]
 
-init_db()
+def check_query_plans(conn) -> list[str]:
+    """检查热点查询是否走了预期的索引，返回没走索引的查询说明"""
+    problems = []
+    for name, sql, params, index in HOT_QUERIES:
+        plan = " / ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+        if index not in plan:
+            problems.append(f"{name}：{plan}")
+    return problems
+
+def init_db():
+    db.run_sync(run_migrations)
+    for problem in db.run_sync(check_query_plans):
+        print(f"[数据库] ⚠️ 查询没有走索引 {problem}")
+
+if not IN_WORKER_PROCESS:
+    init_db()
 
 # ============ Bot 初始化 ============
 intents = discord.Intents.default()
@@ -199,14 +592,183 @@ bot = commands.Bot(command_prefix="!", intents=intents)
 
 # ============ 水印工具函数 ============
 
-def generate_tracking_code():
-    """生成8位追踪码"""
-    return uuid.uuid4().hex[:8].upper()
+# --- 追踪码分配 ---
+# 新追踪码 = 40 位计数器经过带密钥的 Feistel 置换，再用 Crockford base32 写成 8 个字符。
+# 置换是一一对应的，计数器不重复追踪码就不重复；旧追踪码是 8 位十六进制，
+# 新码跳过全是十六进制字符的那些，和旧码也撞不上。
+TRACKING_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+TRACKING_HEX_CHARS = frozenset("0123456789ABCDEF")
+TRACKING_BITS = 40
+TRACKING_FEISTEL_ROUNDS = 4
+# 每次从数据库预留多少个计数，块内分配不用碰数据库
+TRACKING_BLOCK_SIZE = 1000
+
+def feistel_permute(value: int, key: bytes) -> int:
+    """40 位整数上的带密钥置换（左右各 20 位的平衡 Feistel 网络）"""
+    half = TRACKING_BITS // 2
+    mask = (1 << half) - 1
+    left, right = value >> half, value & mask
+    for round_index in range(TRACKING_FEISTEL_ROUNDS):
+        digest = hashlib.blake2b(right.to_bytes(3, "big") + bytes([round_index]), key=key, digest_size=3).digest()
+        left, right = right, left ^ (int.from_bytes(digest, "big") & mask)
+    return (left << half) | right
+
+def tracking_code_from_int(value: int) -> str:
+    return "".join(TRACKING_ALPHABET[(value >> shift) & 31] for shift in range(TRACKING_BITS - 5, -1, -5))
+
+def tracking_code_to_int(tracking_code: str) -> int | None:
+    """新格式追踪码转回 40 位整数；旧格式（全十六进制）或不认识的返回 None"""
+    if len(tracking_code) != 8 or set(tracking_code) <= TRACKING_HEX_CHARS:
+        return None
+    value = 0
+    for char in tracking_code:
+        digit = TRACKING_ALPHABET.find(char)
+        if digit < 0:
+            return None
+        value = (value << 5) | digit
+    return value
+
+def reserve_counter_block(conn, size: int):
+    """预留一段计数，返回 (起点, 终点, 密钥)"""
+    conn.execute("UPDATE tracking_allocator SET next_counter = next_counter + ? WHERE id = 1", (size,))
+    end, secret = conn.execute("SELECT next_counter, secret FROM tracking_allocator WHERE id = 1").fetchone()
+    return end - size, end, secret
+
+class TrackingCodeAllocator:
+    """按块从数据库预留计数，块内每次加一再置换成追踪码"""
+
+    def __init__(self):
+        self.next = 0
+        self.end = 0
+        self.secret = b""
+
+    async def allocate(self) -> str:
+        while True:
+            if self.next >= self.end:
+                # 同时有两个来补块的话各拿一块，后到的覆盖掉先到的，只是浪费一些计数
+                self.next, self.end, self.secret = await db.run(reserve_counter_block, TRACKING_BLOCK_SIZE)
+            counter = self.next
+            self.next += 1
+            if counter >> TRACKING_BITS:
+                raise RuntimeError("追踪码已经用完了")
+            tracking_code = tracking_code_from_int(feistel_permute(counter, self.secret))
+            if not set(tracking_code) <= TRACKING_HEX_CHARS:
+                return tracking_code
+
+tracking_code_allocator = TrackingCodeAllocator()
+
+async def generate_tracking_code() -> str:
+    """分配一个新的 8 位追踪码（不会和已经发出去的重复）"""
+    return await tracking_code_allocator.allocate()
+
+# 图片里的二进制水印：1 字节标记 + 40 位编号 + 1 字节 CRC-8，一共 56 位（旧的文本格式要 104 位）
+TRACKING_PAYLOAD_MAGIC = 0xA5
+TRACKING_PAYLOAD_BITS = 56
+
+def crc8(data: bytes) -> int:
+    """CRC-8（多项式 0x07）"""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
 
 def is_admin(interaction: discord.Interaction) -> bool:
     """检查用户是否为管理员"""
     return any(role.name in ADMIN_ROLE_NAMES for role in interaction.user.roles)
 
+# --- PNG 逐块 / 逐行读取 ---
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PNG 颜色类型 → 每像素字节数（只处理 8 位 RGB / RGBA）
+PNG_CHANNELS = {2: 3, 6: 4}
+# 提取水印时最多读多少个字符；正常标记只有十几个字节，读到这么多还没结束就当作没有
+WATERMARK_SCAN_BYTES = 256
+
+def iter_png_chunks(data):
+    """依次返回 PNG 每个数据块的 (类型, 数据起点, 数据长度)，不复制数据"""
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError("不是PNG文件")
+    pos = 8
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos+8])
+        yield chunk_type, pos + 8, length
+        if chunk_type == b"IEND":
+            return
+        pos += length + 12
+
+def read_png_header(data):
+    """读取 IHDR，返回 (宽, 高, 位深, 颜色类型, 隔行方式)"""
+    for chunk_type, start, length in iter_png_chunks(data):
+        if chunk_type != b"IHDR" or length < 13:
+            break
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", data[start:start+13])
+        return width, height, bit_depth, color_type, interlace
+    raise ValueError("PNG 缺少 IHDR")
+
+def unfilter_png_row(filter_type, line, prev, step):
+    """还原一行 PNG 扫描线的滤波（prev 为上一行已还原的像素）"""
+    row = bytearray(line)
+    if filter_type == 1:
+        for i in range(step, len(row)):
+            row[i] = (row[i] + row[i-step]) & 0xFF
+    elif filter_type == 2:
+        for i in range(len(row)):
+            row[i] = (row[i] + prev[i]) & 0xFF
+    elif filter_type == 3:
+        for i in range(len(row)):
+            left = row[i-step] if i >= step else 0
+            row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xFF
+    elif filter_type == 4:
+        for i in range(len(row)):
+            a = row[i-step] if i >= step else 0
+            b = prev[i]
+            c = prev[i-step] if i >= step else 0
+            p = a + b - c
+            pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+            if pa <= pb and pa <= pc:
+                pred = a
+            elif pb <= pc:
+                pred = b
+            else:
+                pred = c
+            row[i] = (row[i] + pred) & 0xFF
+    elif filter_type != 0:
+        raise ValueError("PNG 滤波类型错误")
+    return row
+
+def _iter_png_rows(data, stride, height, step):
+    decompressor = zlib.decompressobj()
+    prev = bytearray(stride)
+    pending = b""
+    idat = [(start, length) for chunk_type, start, length in iter_png_chunks(data) if chunk_type == b"IDAT"]
+    # 末尾补一个空输入，把解压器里还没吐出来的数据取完
+    for start, length in idat + [(0, 0)]:
+        buf = data[start:start+length]
+        while height:
+            # 每次最多解压一行，后面的像素在用到之前都不会被解出来
+            out = decompressor.decompress(buf, stride + 1 - len(pending))
+            buf = decompressor.unconsumed_tail
+            if not out:
+                break
+            pending += out
+            if len(pending) == stride + 1:
+                prev = unfilter_png_row(pending[0], pending[1:], prev, step)
+                yield prev
+                pending = b""
+                height -= 1
+        if not height:
+            return
+
+def read_png_rows(data):
+    """返回 (宽, 高, 每像素字节数, 逐行生成器)，生成器按需一行行解压还原像素"""
+    width, height, bit_depth, color_type, interlace = read_png_header(data)
+    step = PNG_CHANNELS.get(color_type)
+    if step is None or bit_depth != 8 or interlace:
+        raise ValueError("不支持的PNG格式")
+    return width, height, step, _iter_png_rows(data, width * step, height, step)
+
 # --- 图片隐写水印（LSB） ---
 
 def text_to_bits(text):
@@ -217,6 +779,24 @@ def text_to_bits(text):
             bits.append((byte >> i) & 1)
     return bits
 
+def tracking_watermark_bits(tracking_code):
+    """图片 LSB 里要写的比特：新追踪码用二进制格式，旧追踪码还是写 <<追踪码>> 文本"""
+    value = tracking_code_to_int(tracking_code)
+    if value is None:
+        return text_to_bits(f"<<{tracking_code}>>\x00")
+    payload = bytes([TRACKING_PAYLOAD_MAGIC]) + value.to_bytes(TRACKING_BITS // 8, "big")
+    payload += bytes([crc8(payload)])
+    return [(byte >> i) & 1 for byte in payload for i in range(7, -1, -1)]
+
+def decode_tracking_payload(bits):
+    """解析二进制水印，标记或校验不对返回 None"""
+    if len(bits) < TRACKING_PAYLOAD_BITS:
+        return None
+    payload = bytes(int("".join(map(str, bits[i:i+8])), 2) for i in range(0, TRACKING_PAYLOAD_BITS, 8))
+    if payload[0] != TRACKING_PAYLOAD_MAGIC or crc8(payload[:-1]) != payload[-1]:
+        return None
+    return tracking_code_from_int(int.from_bytes(payload[1:-1], "big"))
+
 def bits_to_text(bits):
     chars = []
     for i in range(0, len(bits), 8):
@@ -231,43 +811,48 @@ def bits_to_text(bits):
         chars.append(chr(byte))
     return ''.join(chars)
 
-def embed_image_watermark(image_bytes, tracking_code):
-    """在图片像素最低位嵌入追踪码，保留PNG元数据"""
-    img = Image.open(io.BytesIO(image_bytes))
+def write_lsb_bits(buf, bits, step):
+    """把比特依次写进像素缓冲区里每个像素前三个通道（RGB）的最低位"""
+    for i, bit in enumerate(bits):
+        pos = (i // 3) * step + i % 3
+        buf[pos] = (buf[pos] & 0xFE) | bit
+
+def embed_image_watermark(image_bytes, tracking_code, output=None):
+    """在图片像素最低位嵌入追踪码，保留PNG元数据
+
+    image_bytes 也可以是文件路径（直接从磁盘解码）；给了 output 就写进这个文件对象，不返回字节。
+    """
+    img = Image.open(image_bytes if isinstance(image_bytes, str) else io.BytesIO(image_bytes))
     original_format = img.format
-    original_mode = img.mode
-    
+
     # 保留PNG元数据
     png_info = img.info if original_format == "PNG" else {}
-    
-    img = img.convert("RGB")
-    pixels = list(img.getdata())
-
-    message = f"<<{tracking_code}>>\x00"
-    bits = text_to_bits(message)
 
-    if len(bits) > len(pixels) * 3:
-        raise ValueError("图片太小，无法嵌入水印")
+    # 带透明通道的图保持 RGBA（不丢 alpha），其余按 RGB 处理
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        mode = "RGBA"
+    else:
+        mode = "RGB"
+    if img.mode != mode:
+        img = img.convert(mode)
 
-    new_pixels = []
-    bit_idx = 0
-    for pixel in pixels:
-        new_pixel = list(pixel)
-        for channel in range(3):
-            if bit_idx < len(bits):
-                new_pixel[channel] = (new_pixel[channel] & 0xFE) | bits[bit_idx]
-                bit_idx += 1
-        new_pixels.append(tuple(new_pixel))
+    bits = tracking_watermark_bits(tracking_code)
 
-    new_img = Image.new("RGB", img.size)
-    new_img.putdata(new_pixels)
+    width, height = img.size
+    if len(bits) > width * height * 3:
+        raise ValueError("图片太小，无法嵌入水印")
 
-    output = io.BytesIO()
-    if original_mode == "RGBA":
-        new_img = new_img.convert("RGBA")
+    # 只取出水印会碰到的前几行，直接在原始像素字节里改最低位，再贴回原图
+    pixel_count = (len(bits) + 2) // 3
+    rows = (pixel_count + width - 1) // width
+    band = img.crop((0, 0, width, rows))
+    buf = bytearray(band.tobytes())
+    write_lsb_bits(buf, bits, len(mode))
+    img.paste(Image.frombytes(mode, band.size, bytes(buf)), (0, 0))
 
+    target = output or io.BytesIO()
     if original_format == "JPEG":
-        new_img.save(output, format="JPEG", quality=95)
+        img.save(target, format="JPEG", quality=95)
     else:
         # 保留PNG的text chunks元数据
         from PIL import PngImagePlugin
@@ -277,51 +862,300 @@ def embed_image_watermark(image_bytes, tracking_code):
                 png_meta.add_text(key, value)
             elif isinstance(value, bytes):
                 png_meta.add_text(key, value.decode('latin-1'))
-        new_img.save(output, format="PNG", pnginfo=png_meta)
-
-    output.seek(0)
-    return output.getvalue()
-
-def extract_image_watermark(image_bytes):
-    """从图片中提取隐藏的追踪码"""
-    img = Image.open(io.BytesIO(image_bytes))
-    img = img.convert("RGB")
-    pixels = list(img.getdata())
-
-    bits = []
-    for pixel in pixels:
-        for channel in range(3):
-            bits.append(pixel[channel] & 1)
+        img.save(target, format="PNG", pnginfo=png_meta)
+
+    if output is None:
+        return target.getvalue()
+
+def iter_lsb_bits(rows, step):
+    """按顺序取出每行像素 RGB 通道的最低位"""
+    for row in rows:
+        for i in range(0, len(row) - step + 1, step):
+            yield row[i] & 1
+            yield row[i + 1] & 1
+            yield row[i + 2] & 1
+
+def read_lsb_text(bits, limit=None):
+    """把比特按 8 位一组拼成文本，读到 NUL 或 >> 就停"""
+    limit = limit or WATERMARK_SCAN_BYTES
+    chars = []
+    byte = 0
+    nbits = 0
+    for bit in bits:
+        byte = (byte << 1) | bit
+        nbits += 1
+        if nbits < 8:
+            continue
+        if byte == 0:
+            break
+        chars.append(chr(byte))
+        if chars[-2:] == ['>', '>'] or len(chars) >= limit:
+            break
+        byte = 0
+        nbits = 0
+    return ''.join(chars)
 
-    text = bits_to_text(bits)
+def read_lsb_watermark(rows, step):
+    """读出像素里的追踪码：先按二进制格式解析，不是的话按旧的 <<追踪码>> 文本解析"""
+    bits = iter_lsb_bits(rows, step)
+    head = list(itertools.islice(bits, TRACKING_PAYLOAD_BITS))
+    tracking_code = decode_tracking_payload(head)
+    if tracking_code:
+        return tracking_code
+    text = read_lsb_text(itertools.chain(head, bits))
     start = text.find("<<")
     end = text.find(">>")
     if start != -1 and end != -1:
         return text[start+2:end]
     return None
 
+def extract_image_watermark(image_bytes):
+    """从图片中提取隐藏的追踪码（只解码开头几行，读到结束标记就停）"""
+    # 角色卡 PNG 的追踪码写在数据块里，先看数据块
+    if image_bytes[:8] == PNG_SIGNATURE:
+        tracking_code = extract_png_card_watermark(image_bytes)
+        if tracking_code:
+            return tracking_code
+
+    try:
+        _, _, step, rows = read_png_rows(image_bytes)
+        return read_lsb_watermark(rows, step)
+    except (ValueError, zlib.error):
+        # JPEG 或不常见的 PNG 格式交给 Pillow，只裁出开头够用的几行来读
+        img = Image.open(io.BytesIO(image_bytes))
+        width, height = img.size
+        rows_needed = min(height, (WATERMARK_SCAN_BYTES * 8 // 3 + width) // width + 1)
+        band = img.crop((0, 0, width, rows_needed))
+        if band.mode not in ("RGB", "RGBA"):
+            band = band.convert("RGB")
+        return read_lsb_watermark([band.tobytes()], len(band.mode))
+
+# --- PNG 增量重编码（只重新压缩水印所在的几行） ---
+
+# 为水印预留的最多比特数，预留行要能装下最长的标记
+WATERMARK_RESERVED_BITS = 128
+PNG_TEMPLATE_MAGIC = b"WMT1"
+PNG_TEMPLATE_HEADER = struct.Struct(">4sBIIIIIII")
+
+def adler32_combine(adler1, adler2, len2):
+    """合并两段数据的 adler32（同 zlib 的 adler32_combine）"""
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1) % base
+    sum1 += (adler2 & 0xFFFF) + base - 1
+    sum2 += ((adler1 >> 16) & 0xFFFF) + ((adler2 >> 16) & 0xFFFF) + base - rem
+    return (sum1 % base) | ((sum2 % base) << 16)
+
+def sub_filter_row(row, step):
+    """对一行像素做 Sub 滤波（只依赖本行，不依赖上一行）"""
+    out = bytearray(row)
+    for i in range(step, len(row)):
+        out[i] = (row[i] - row[i-step]) & 0xFF
+    return out
+
+def build_png_template(png_bytes):
+    """上传时预处理 PNG：开头几行存原始像素，其余行单独压缩好并做成现成的 IDAT 块
+
+    不支持的格式（非 8 位 RGB/RGBA、隔行、图太小）返回 None。
+    """
+    if png_bytes[:8] != PNG_SIGNATURE:
+        return None
+    width, height, bit_depth, color_type, interlace = read_png_header(png_bytes)
+    step = PNG_CHANNELS.get(color_type)
+    if step is None or bit_depth != 8 or interlace or width * height * 3 < WATERMARK_RESERVED_BITS:
+        return None
+
+    stride = width * step
+    line = stride + 1
+    rows = min(height, ((WATERMARK_RESERVED_BITS + 2) // 3 + width - 1) // width)
+    idat = [(start, length) for chunk_type, start, length in iter_png_chunks(png_bytes) if chunk_type == b"IDAT"]
+    head = png_bytes[:idat[0][0] - 8]
+    trailer = png_bytes[idat[-1][0] + idat[-1][1] + 4:]
+
+    decompressor = zlib.decompressobj()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    tail_parts = []
+    tail_adler = 1
+    tail_len = 0
+    prefix = bytearray()
+    prev = bytearray(stride)
+    row_index = 0
+    buf = bytearray()
+    for start, length in idat + [(None, 0)]:
+        buf += decompressor.decompress(png_bytes[start:start+length]) if start is not None else decompressor.flush()
+        # 预留行还原成像素；紧接着的第一行改成 Sub 滤波，这样预留行改动后它也不用重算
+        while row_index <= rows and row_index < height and len(buf) >= line:
+            prev = unfilter_png_row(buf[0], buf[1:line], prev, step)
+            del buf[:line]
+            if row_index < rows:
+                prefix += prev
+                row_index += 1
+                continue
+            buf[0:0] = b"\x01" + sub_filter_row(prev, step)
+            row_index += 1
+            break
+        if row_index > rows and buf:
+            tail_adler = zlib.adler32(buf, tail_adler)
+            tail_len += len(buf)
+            tail_parts.append(compressor.compress(bytes(buf)))
+            buf.clear()
+    tail_parts.append(compressor.flush())
+    if len(prefix) != rows * stride or tail_len != (height - rows) * line:
+        return None
+
+    tail_chunk = make_png_chunk(b"IDAT", b"".join(tail_parts))
+    return b"".join([
+        PNG_TEMPLATE_HEADER.pack(PNG_TEMPLATE_MAGIC, step, width, rows, len(head), len(tail_chunk), len(trailer), tail_adler, tail_len),
+        head, prefix, tail_chunk, trailer,
+    ])
+
+def parse_png_template(template):
+    """拆开预处理结果，返回 (每像素字节数, 宽, 预留行数, 头部, 预留像素, 尾部 IDAT 块, 结尾块, 尾部 adler32, 尾部长度)"""
+    magic, step, width, rows, head_len, tail_chunk_len, trailer_len, tail_adler, tail_len = PNG_TEMPLATE_HEADER.unpack_from(template)
+    if magic != PNG_TEMPLATE_MAGIC:
+        raise ValueError("水印缓存已损坏")
+    view = memoryview(template)
+    pos = PNG_TEMPLATE_HEADER.size
+    parts = []
+    for size in (head_len, rows * width * step, tail_chunk_len, trailer_len):
+        parts.append(view[pos:pos+size])
+        pos += size
+    head, prefix, tail_chunk, trailer = parts
+    return step, width, rows, head, prefix, tail_chunk, trailer, tail_adler, tail_len
+
+def render_png_template(template, tracking_code):
+    """用预处理结果生成带水印的 PNG：只重新滤波、压缩预留行，其余数据直接拼接"""
+    return b"".join(render_png_template_parts(template, tracking_code))
+
+def render_png_template_parts(template, tracking_code):
+    """同 render_png_template，但按顺序返回各部分（大部分是模板的切片），可以直接依次写进文件"""
+    step, width, rows, head, prefix, tail_chunk, trailer, tail_adler, tail_len = parse_png_template(template)
+    bits = tracking_watermark_bits(tracking_code)
+    if len(bits) > rows * width * 3:
+        raise ValueError("图片太小，无法嵌入水印")
+
+    pixels = bytearray(prefix)
+    write_lsb_bits(pixels, bits, step)
+    stride = width * step
+    lines = b"".join(b"\x00" + pixels[i:i+stride] for i in range(0, len(pixels), stride))
+
+    # 预留行压缩成不结束的 deflate 块，后面直接接上缓存好的尾部压缩流
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    head_stream = b"\x78\x9c" + compressor.compress(lines) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    adler = adler32_combine(zlib.adler32(lines), tail_adler, tail_len)
+    return [
+        head,
+        make_png_chunk(b"IDAT", head_stream),
+        tail_chunk,
+        make_png_chunk(b"IDAT", struct.pack(">I", adler)),
+        trailer,
+    ]
+
 # --- JSON 水印（extensions字段） ---
 
-def embed_json_watermark(json_bytes, tracking_code):
-    """在 JSON 文件的 extensions 字段中嵌入追踪码"""
-    content = json_bytes.decode('utf-8')
-    data = json.loads(content)
+# JSON 结构符号和字符串（数字、true/false/null、空白都直接跳过）
+JSON_TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]:,]')
+JSON_SLOT_MAGIC = b"WMJ1"
+# 只关心根对象、data、extensions 这几层
+JSON_WATCHED_PATHS = {(), ("data",), ("extensions",), ("data", "extensions")}
+JSON_WATCHED_KEYS = {"data", "extensions", "tracking_id"}
+
+def scan_json_objects(json_bytes):
+    """扫描一遍 JSON 的结构符号，记录关心的几层对象里 data/extensions/tracking_id 的字节位置
+
+    返回 {路径: {"open": 左花括号之后的位置, "empty": 是否空对象, "fields": {键: (值起点, 值终点)}}}
+    """
+    objects = {}
+    stack = []  # 每层：[路径, 是否对象, 当前键, 值起点]
+    for m in JSON_TOKEN.finditer(json_bytes):
+        token = m.group()
+        if token in (b"{", b"["):
+            if stack:
+                parent = stack[-1]
+                path = parent[0] + ((parent[2],) if parent[1] else (None,))
+            else:
+                path = ()
+            stack.append([path, token == b"{", None, None])
+            if token == b"{" and path in JSON_WATCHED_PATHS:
+                objects[path] = {"open": m.end(), "empty": True, "fields": {}}
+        elif token in (b"}", b"]", b","):
+            frame = stack[-1]
+            if frame[1] and frame[2] is not None and frame[0] in objects and frame[2] in JSON_WATCHED_KEYS:
+                # 值的范围：冒号之后到这个符号之前，去掉两端空白
+                start = frame[3]
+                end = m.start()
+                while json_bytes[start:start+1].isspace():
+                    start += 1
+                while end > start and json_bytes[end-1:end].isspace():
+                    end -= 1
+                objects[frame[0]]["fields"][frame[2]] = (start, end)
+            frame[2] = None
+            if token != b",":
+                stack.pop()
+        elif token == b":":
+            stack[-1][3] = m.end()
+        elif stack and stack[-1][1] and stack[-1][2] is None:
+            frame = stack[-1]
+            frame[2] = json.loads(token)
+            if frame[0] in objects:
+                objects[frame[0]]["empty"] = False
+    return objects
+
+def find_json_watermark_slot(json_bytes):
+    """上传时算好追踪码插在哪里，返回 (起点, 终点, 前缀, 后缀)；不是合法的 JSON 对象返回 None
+
+    规则和 embed_json_watermark 一样：data 是对象就写进 data.extensions，否则写进顶层 extensions。
+    """
+    try:
+        data = json.loads(json_bytes.decode('utf-8-sig'))
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
 
-    # 在 extensions 字段中存入追踪码（符合角色卡V3规范）
-    if 'data' in data and isinstance(data['data'], dict):
-        if 'extensions' not in data['data'] or not isinstance(data['data'].get('extensions'), dict):
-            data['data']['extensions'] = {}
-        data['data']['extensions']['tracking_id'] = tracking_code
-    else:
-        if 'extensions' not in data or not isinstance(data.get('extensions'), dict):
-            data['extensions'] = {}
-        data['extensions']['tracking_id'] = tracking_code
+    objects = scan_json_objects(json_bytes)
+    base = ("data",) if isinstance(data.get('data'), dict) else ()
+    parent = data['data'] if base else data
+    if isinstance(parent.get('extensions'), dict):
+        ext = objects[base + ("extensions",)]
+        if "tracking_id" in ext["fields"]:
+            start, end = ext["fields"]["tracking_id"]
+            return start, end, "", ""
+        return ext["open"], ext["open"], '"tracking_id": ', "" if ext["empty"] else ", "
+    container = objects[base]
+    if "extensions" in container["fields"]:
+        # extensions 不是对象：整个换掉
+        start, end = container["fields"]["extensions"]
+        return start, end, '{"tracking_id": ', "}"
+    suffix = "}" if container["empty"] else "}, "
+    return container["open"], container["open"], '"extensions": {"tracking_id": ', suffix
+
+def splice_json_watermark(json_bytes, slot, tracking_code):
+    """按上传时记下的位置把追踪码拼进原文件，其余字节原样保留"""
+    return b"".join(splice_json_watermark_parts(json_bytes, slot, tracking_code))
+
+def splice_json_watermark_parts(json_bytes, slot, tracking_code):
+    start, end, prefix, suffix = slot
+    view = memoryview(json_bytes)
+    insert = (prefix + json.dumps(tracking_code, ensure_ascii=False) + suffix).encode('utf-8')
+    return [view[:start], insert, view[end:]]
 
-    return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+def embed_json_watermark(json_bytes, tracking_code):
+    """在 JSON 文件的 extensions 字段中嵌入追踪码（保持原文件格式）"""
+    slot = find_json_watermark_slot(json_bytes)
+    if slot is None:
+        raise ValueError("不是有效的 JSON 对象")
+    return splice_json_watermark(json_bytes, slot, tracking_code)
 
 def extract_json_watermark(json_bytes):
     """从 JSON 文件的 extensions 字段中提取追踪码"""
-    content = json_bytes.decode('utf-8')
+    # 文件里根本没有 tracking_id 这个键（也没有能把键名写成转义形式的 \u）就不用解析了；
+    # 有的话得整个解析，只认 data.extensions / extensions 下面的，世界书条目或插件数据里同名的键不算
+    if b'"tracking_id"' not in json_bytes and b"\\u" not in json_bytes:
+        return None
+
+    content = json_bytes.decode('utf-8-sig')
     data = json.loads(content)
 
     # 从 data.extensions 提取
@@ -337,6 +1171,1127 @@ def extract_json_watermark(json_bytes):
 
     return None
 
+# --- PNG 角色卡水印（数据块级，不解码像素） ---
+
+# SillyTavern 角色卡把 base64 编码的 JSON 放在这两个 tEXt 数据块里
+CARD_CHUNK_KEYS = (b"chara", b"ccv3")
+# 追踪码单独存放的 tEXt 关键字
+TRACKING_CHUNK_KEY = b"tracking_id"
+# 角色卡的预处理缓存：每个卡片数据块解码后的 JSON 里追踪码插在哪里
+CARD_SLOT_MAGIC = b"WMC1"
+
+def make_png_chunk(chunk_type, body):
+    """拼出一个完整的 PNG 数据块（长度 + 类型 + 内容 + CRC）"""
+    return struct.pack(">I", len(body)) + chunk_type + body + struct.pack(">I", zlib.crc32(chunk_type + body))
+
+def iter_png_text_chunks(data):
+    """遍历 tEXt 数据块，返回 (关键字, 文本内容)"""
+    for chunk_type, start, length in iter_png_chunks(data):
+        if chunk_type == b"tEXt":
+            key, _, value = bytes(data[start:start+length]).partition(b"\x00")
+            yield key, value
+
+def is_png_character_card(data):
+    """判断 PNG 里是否带有角色卡数据块"""
+    if data[:8] != PNG_SIGNATURE:
+        return False
+    return any(key in CARD_CHUNK_KEYS for key, _ in iter_png_text_chunks(data))
+
+def embed_png_card_watermark(png_bytes, tracking_code):
+    """只改写数据块给角色卡打水印：像素数据原样复制，追踪码写进 tracking_id 块和卡片 JSON"""
+    return b"".join(png_card_watermark_parts(png_bytes, tracking_code))
+
+def find_card_watermark_slots(png_bytes):
+    """上传时算好每个卡片数据块（解码后的 JSON）里追踪码插在哪里：{关键字: 插入位置}，卡片 JSON 坏了的不记"""
+    slots = {}
+    for key, value in iter_png_text_chunks(png_bytes):
+        if key in CARD_CHUNK_KEYS:
+            try:
+                slot = find_json_watermark_slot(base64.b64decode(value))
+            except (ValueError, TypeError):
+                slot = None
+            if slot:
+                slots[key.decode("latin-1")] = slot
+    return slots
+
+def png_card_watermark_parts(png_bytes, tracking_code, slots=None):
+    """slots 是 find_card_watermark_slots 的结果；有的话按位置直接拼，不用再解析卡片 JSON"""
+    view = memoryview(png_bytes)
+    parts = [view[:8]]
+    code = tracking_code.encode("ascii")
+    for chunk_type, start, length in iter_png_chunks(png_bytes):
+        raw = view[start-8:start+length+4]
+        if chunk_type == b"tEXt":
+            key, _, value = bytes(view[start:start+length]).partition(b"\x00")
+            if key == TRACKING_CHUNK_KEY:
+                continue
+            if key in CARD_CHUNK_KEYS:
+                try:
+                    if slots is None:
+                        card_json = embed_json_watermark(base64.b64decode(value), tracking_code)
+                    elif key.decode("latin-1") in slots:
+                        card_json = splice_json_watermark(base64.b64decode(value), slots[key.decode("latin-1")], tracking_code)
+                    else:
+                        raise ValueError("卡片 JSON 上传时就解析不了")
+                    raw = make_png_chunk(b"tEXt", key + b"\x00" + base64.b64encode(card_json))
+                except (ValueError, TypeError):
+                    pass  # 卡片 JSON 坏了就原样保留，tracking_id 块里还有追踪码
+        elif chunk_type == b"IEND":
+            parts.append(make_png_chunk(b"tEXt", TRACKING_CHUNK_KEY + b"\x00" + code))
+        parts.append(raw)
+    return parts
+
+def extract_png_card_watermark(png_bytes):
+    """从 PNG 数据块中提取追踪码：先看 tracking_id 块，再看角色卡 JSON"""
+    cards = {}
+    for key, value in iter_png_text_chunks(png_bytes):
+        if key == TRACKING_CHUNK_KEY:
+            return value.decode("latin-1")
+        if key in CARD_CHUNK_KEYS:
+            cards[key] = value
+    for key in reversed(CARD_CHUNK_KEYS):
+        if key not in cards:
+            continue
+        try:
+            tracking_code = extract_json_watermark(base64.b64decode(cards[key]))
+        except (ValueError, TypeError, AttributeError):
+            continue
+        if tracking_code:
+            return tracking_code
+    return None
+
+# ============ 内容寻址文件仓库 ============
+
+def write_file_atomic(path: str, data):
+    """先写临时文件再改名，别人读到的要么是旧文件要么是完整的新文件"""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def blob_path(content_hash: str, ext: str) -> str:
+    return os.path.join(BLOBS_DIR, content_hash[:2], content_hash[2:4], content_hash + ext.lower())
+
+def put_blob(file_bytes, ext: str):
+    """把文件存进仓库，返回 (内容哈希, 路径)；同样的内容已经存过就不再写"""
+    content_hash = hashlib.sha256(file_bytes).hexdigest()
+    path = blob_path(content_hash, ext)
+    if os.path.exists(path):
+        # 刷新修改时间，清理时不会误删马上要被引用的文件
+        os.utime(path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file_atomic(path, file_bytes)
+    return content_hash, path
+
+def commit_blob(tmp_path: str, path: str):
+    """把下载好的临时文件放到仓库里的正式位置；同样的内容已经有了就丢掉临时文件"""
+    if os.path.exists(path):
+        os.utime(path)
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+INSERT_FILE_SQL = "INSERT {}INTO files (thread_id, post_name, file_name, version, file_path, file_type, uploaded_by, uploaded_at, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+def insert_file_row(conn, tmp_path: str, row):
+    """在数据库线程上把文件放进仓库并记录（和清理排在同一个线程上，放进去的文件不会被当成没人引用）"""
+    thread_id, post_name, file_name, version, file_path, file_type, uploaded_by, content_hash = row
+    commit_blob(tmp_path, file_path)
+    conn.execute(
+        INSERT_FILE_SQL.format(""),
+        (thread_id, post_name, file_name, version, file_path, file_type, uploaded_by, datetime.now().isoformat(), content_hash)
+    )
+
+def insert_file_rows(conn, items) -> list[bool]:
+    """批量上传：所有记录在同一个事务里写入，同名同版本已经有了的跳过；返回每一条是否写入"""
+    uploaded_at = datetime.now().isoformat()
+    inserted = []
+    for tmp_path, row in items:
+        thread_id, post_name, file_name, version, file_path, file_type, uploaded_by, content_hash = row
+        commit_blob(tmp_path, file_path)
+        cursor = conn.execute(
+            INSERT_FILE_SQL.format("OR IGNORE "),
+            (thread_id, post_name, file_name, version, file_path, file_type, uploaded_by, uploaded_at, content_hash)
+        )
+        inserted.append(cursor.rowcount == 1)
+    return inserted
+
+def release_file(conn, file_path: str) -> bool:
+    """在数据库线程上检查引用数，没有记录再指向这个文件就连同水印缓存一起删掉；返回是否删了"""
+    refs = conn.execute("SELECT COUNT(*) FROM files WHERE file_path = ?", (file_path,)).fetchone()[0]
+    if refs:
+        return False
+    for path in (file_path, watermark_cache_path(file_path)):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except Exception:
+            pass
+    return True
+
+def delete_file_row(conn, file_id: int, file_path: str) -> bool:
+    conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+    return release_file(conn, file_path)
+
+UTF8_BOM = b"\xef\xbb\xbf"
+JSON_WHITESPACE = b" \t\r\n"
+SNIFF_HEAD_BYTES = 64
+
+def json_text_start(head: bytes) -> bytes:
+    """去掉 BOM 和前导空白，剩下的就是 JSON 正文的开头"""
+    return head.removeprefix(UTF8_BOM).lstrip(JSON_WHITESPACE)
+
+def extend_sniff_head(head: bytes, chunk: bytes) -> bytes:
+    """下载时攒文件开头给 sniff_file_type 用：先攒够 64 字节，
+    前面还全是空白（格式化过的 JSON 可能先空好几行）的话，跳过空白再攒一段正文"""
+    if len(head) < SNIFF_HEAD_BYTES:
+        take = SNIFF_HEAD_BYTES - len(head)
+        head, chunk = head + chunk[:take], chunk[take:]
+    if chunk and not json_text_start(head):
+        head += chunk.lstrip(JSON_WHITESPACE)[:SNIFF_HEAD_BYTES]
+    return head
+
+class UnsupportedUpload(Exception):
+    """上传的文件内容和扩展名对不上，不收"""
+
+def sniff_file_type(head: bytes, filename: str):
+    """按文件开头的魔数判断类型，返回 (file_type, 扩展名)
+
+    图片看魔数；扩展名是 .json 的要求是 JSON 对象（水印要写进对象里），允许带 BOM 和前导空白，
+    顶层是数组之类的抛 UnsupportedUpload，不收；其他扩展名的文本和代码都当普通文件，原样保存、原样发。
+    """
+    if head.startswith(PNG_SIGNATURE):
+        return "image", ".png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image", ".jpg"
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".json":
+        if json_text_start(head)[:1] != b"{":
+            raise UnsupportedUpload("这个 .json 文件最外层不是 JSON 对象（{ ... }），鹅没法往里写追踪码")
+        return "json", ".json"
+    return "other", ext
+
+# 下载附件共用的 HTTP 会话（第一次用时创建）
+_http_session: aiohttp.ClientSession | None = None
+
+def http_session() -> aiohttp.ClientSession:
+    """整个运行期间共用一个会话；连接池借 discord.py 的，它退出时一起关掉"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = bot.http.connector
+        if isinstance(connector, aiohttp.BaseConnector) and not connector.closed:
+            _http_session = aiohttp.ClientSession(connector=connector, connector_owner=False)
+        else:
+            # 还没登录（比如脚本里直接调用）：自己开一个
+            _http_session = aiohttp.ClientSession()
+    return _http_session
+
+def new_ingest_path() -> str:
+    """仓库里放下载中临时文件的路径（和正式位置在同一个文件系统，改名是原子的）"""
+    os.makedirs(BLOBS_DIR, exist_ok=True)
+    return os.path.join(BLOBS_DIR, f"incoming-{uuid.uuid4().hex}.tmp")
+
+async def ingest_attachment(attachment: discord.Attachment):
+    """把附件分块下载到临时文件，边下边算 SHA-256、认文件类型，整个文件不会同时待在内存里
+
+    返回 (临时文件路径, 内容哈希, file_type, 扩展名)；临时文件由调用方放进仓库或删掉。
+    """
+    tmp_path = new_ingest_path()
+    digest = hashlib.sha256()
+    head = b""
+    try:
+        with open(tmp_path, 'wb') as f:
+            async with http_session().get(attachment.url) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.content.iter_chunked(INGEST_CHUNK_BYTES):
+                    head = extend_sniff_head(head, chunk)
+                    digest.update(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+            await asyncio.to_thread(os.fsync, f.fileno())
+        file_type, ext = sniff_file_type(head, attachment.filename)
+    except BaseException:
+        discard_ingested(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), file_type, ext
+
+def discard_ingested(tmp_path: str):
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+
+# ============ 热门文件缓存 ============
+
+class AssetCache:
+    """按文件路径缓存原始字节和水印预处理结果，超出内存预算时淘汰最久没用的
+
+    新文件的路径就是内容哈希，内容相同的几个版本共用一份缓存，文件也不会被原地覆盖。
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget = budget_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _sizeof(asset):
+        return sum(len(part) for part in asset if isinstance(part, (bytes, bytearray)))
+
+    def get(self, file_path: str):
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(file_path)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, file_path: str, asset):
+        size = self._sizeof(asset)
+        with self.lock:
+            self._drop(file_path)
+            if size > self.budget:
+                return
+            self.entries[file_path] = (asset, size)
+            self.size += size
+            while self.size > self.budget:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def _drop(self, file_path: str):
+        entry = self.entries.pop(file_path, None)
+        if entry:
+            self.size -= entry[1]
+
+    def invalidate(self, file_path: str):
+        """文件从磁盘上删掉或搬走时调用"""
+        with self.lock:
+            self._drop(file_path)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+asset_cache = AssetCache(ASSET_CACHE_MB * 1024 * 1024)
+
+def watermark_cache_path(file_path):
+    """文件对应的水印预处理缓存路径"""
+    return file_path + ".wm"
+
+def build_watermark_prep(file_bytes, file_type):
+    """算出打水印要用的预处理数据：普通 PNG 是增量编码模板，角色卡和 JSON 是追踪码插入位置"""
+    if file_type == "image" and is_png_character_card(file_bytes):
+        return CARD_SLOT_MAGIC + json.dumps(find_card_watermark_slots(file_bytes)).encode('utf-8')
+    if file_type == "image":
+        return build_png_template(file_bytes)
+    if file_type == "json":
+        slot = find_json_watermark_slot(file_bytes)
+        if slot:
+            return JSON_SLOT_MAGIC + json.dumps(slot).encode('utf-8')
+    return None
+
+def prepare_watermark_cache(file_path, file_bytes, file_type):
+    """上传时生成水印预处理缓存并写到文件旁边，返回缓存内容"""
+    prep = build_watermark_prep(file_bytes, file_type)
+    cache_path = watermark_cache_path(file_path)
+    if prep:
+        write_file_atomic(cache_path, prep)
+    elif os.path.exists(cache_path):
+        os.remove(cache_path)  # 同路径旧文件留下的缓存已经不对了
+    return prep
+
+def prepare_watermark_cache_from(source_path, file_path, file_type):
+    """从磁盘上的文件（比如还没放进仓库的临时文件）生成 file_path 的水印预处理缓存"""
+    with open(source_path, 'rb') as f:
+        file_bytes = f.read()
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    return prepare_watermark_cache(file_path, file_bytes, file_type)
+
+def load_watermark_prep(file_path, file_bytes, file_type):
+    """读取水印预处理缓存，旧文件没有缓存时现场生成一次"""
+    cache_path = watermark_cache_path(file_path)
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            return f.read()
+    return prepare_watermark_cache(file_path, file_bytes, file_type)
+
+def estimate_job_memory(file_path: str, file_bytes, prep, is_card: bool, file_type: str) -> int:
+    """估算打一次水印额外要占多少内存（原始字节和预处理数据已经在缓存里，不算）"""
+    if file_type == "image" and is_card:
+        # 卡片 JSON 要 base64 解码、加追踪码、再编码回去
+        return len(file_bytes) * 3
+    if file_type == "image" and prep:
+        # 只有预留行要重新滤波、压缩
+        _, step, width, rows = PNG_TEMPLATE_HEADER.unpack_from(prep)[:4]
+        return rows * width * step * 3
+    if file_type == "image":
+        # 完整解码：原图像素、转换模式后的一份，再加上编码输出
+        with Image.open(file_path) as img:
+            width, height = img.size
+        return width * height * 4 * 2 + os.path.getsize(file_path)
+    if file_type == "json" and not prep:
+        return len(file_bytes) * 2
+    return 0
+
+def load_asset(file_path: str, file_type: str):
+    """准备好打水印需要的数据，返回 (原始字节, 预处理数据, 是否角色卡, 估算的任务内存)
+
+    有模板的 PNG 只要模板；要完整解码的图片在干活的时候直接从磁盘读；这两种都不留原始字节。
+    """
+    asset = asset_cache.get(file_path)
+    if asset is not None:
+        return asset
+    file_bytes = None
+    prep = None
+    is_card = False
+    cache_path = watermark_cache_path(file_path)
+    if file_type == "image" and os.path.exists(cache_path):
+        # 图片有预处理缓存：普通 PNG 的模板用不着原文件，角色卡的插入位置还要配原文件
+        with open(cache_path, 'rb') as f:
+            prep = f.read()
+        is_card = prep.startswith(CARD_SLOT_MAGIC)
+        if is_card:
+            with open(file_path, 'rb') as f:
+                file_bytes = f.read()
+    else:
+        with open(file_path, 'rb') as f:
+            file_bytes = f.read()
+        is_card = file_type == "image" and is_png_character_card(file_bytes)
+        prep = load_watermark_prep(file_path, file_bytes, file_type)
+        if file_type == "image" and not is_card:
+            file_bytes = None
+    asset = (file_bytes, prep, is_card, estimate_job_memory(file_path, file_bytes, prep, is_card, file_type))
+    asset_cache.put(file_path, asset)
+    return asset
+
+def write_watermarked(asset, file_type: str, file_path: str, tracking_code: str, out_path: str) -> str:
+    """给文件打上追踪码，结果按部分依次写进 out_path（不先拼成一整块），返回扩展名"""
+    file_bytes, prep, is_card, _ = asset
+    with open(out_path, 'wb') as out:
+        if file_type == "image" and is_card:
+            # 角色卡只改数据块，不解码像素；卡片 JSON 按上传时记下的位置拼接
+            slots = json.loads(prep[len(CARD_SLOT_MAGIC):]) if prep else None
+            out.writelines(png_card_watermark_parts(file_bytes, tracking_code, slots))
+            return ".png"
+        if file_type == "image" and prep:
+            # 普通 PNG 只重新压缩水印所在的几行
+            out.writelines(render_png_template_parts(prep, tracking_code))
+            return ".png"
+        if file_type == "image":
+            original_ext = os.path.splitext(file_path)[1].lower()
+            embed_image_watermark(file_path, tracking_code, output=out)
+            return original_ext if original_ext in ('.png', '.jpg', '.jpeg') else '.png'
+        if file_type == "json" and prep:
+            # 按上传时记下的位置直接拼接，不重新解析和格式化
+            slot = json.loads(prep[len(JSON_SLOT_MAGIC):])
+            out.writelines(splice_json_watermark_parts(file_bytes, slot, tracking_code))
+            return ".json"
+        if file_type == "json":
+            out.write(embed_json_watermark(file_bytes, tracking_code))
+            return ".json"
+    raise ValueError("这种文件不打水印")
+
+# ============ 水印工作进程池 ============
+
+def extract_watermark(file_name: str, file_bytes):
+    """根据文件类型提取追踪码，不认识的类型返回 None"""
+    if file_name.lower().endswith(('.png', '.jpg', '.jpeg')):
+        return extract_image_watermark(file_bytes)
+    if file_name.lower().endswith('.json'):
+        return extract_json_watermark(file_bytes)
+    return None
+
+class WatermarkBusy(Exception):
+    """水印任务排队已满"""
+
+class WatermarkTooLarge(Exception):
+    """水印任务估算要用的内存超过了单任务上限"""
+
+def new_delivery_path() -> str:
+    return os.path.join(DELIVERY_DIR, f"{uuid.uuid4().hex}.tmp")
+
+def discard_delivery(path: str | None):
+    """删掉发完（或者没用上）的水印文件"""
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+# 上次运行没发出去的文件都没用了
+if not IN_WORKER_PROCESS:
+    for _leftover in os.listdir(DELIVERY_DIR):
+        discard_delivery(os.path.join(DELIVERY_DIR, _leftover))
+
+class WatermarkService:
+    """把水印相关的计算和文件读写挪出事件循环：
+    需要完整解码像素的重活交给进程池，其余的（读文件、拼数据块、JSON）交给线程。
+
+    进程池用 forkserver 启动：机器人进程里已经跑着事件循环和数据库线程，直接 fork
+    可能把别的线程拿着的锁一起带进子进程，卡死在里面。
+    任务超时后，进程池里的直接杀掉工作进程重建；线程停不下来，就等它真正跑完才让出名额，
+    所以同时在跑的任务数和内存始终受 workers / 排队预算限制。
+    """
+
+    def __init__(self, workers: int, queue_size: int, timeout: float, job_limit: int):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.job_limit = job_limit
+        self.pending = 0
+        self._slots = asyncio.Semaphore(self.workers)
+        self._pool = None
+
+    def start(self):
+        """启动时建好进程池（建不了就一直用线程）"""
+        if self._pool is None:
+            try:
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("forkserver"))
+            except (ValueError, OSError) as e:
+                print(f"[水印] 进程池不可用，改用线程：{e}")
+                self._pool = False
+        return self._pool or None
+
+    def _restart_pool(self, pool):
+        """杀掉进程池里的工作进程（超时的任务还在跑）并换一个新的；别的任务已经换过了就不动"""
+        if pool is not self._pool:
+            return
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+        self.start()
+
+    async def _run(self, heavy: bool, func, *args):
+        if self.pending >= self.queue_size:
+            raise WatermarkBusy("鹅现在忙不过来啦")
+        self.pending += 1
+        try:
+            async with self._slots:
+                pool = self.start() if heavy else None
+                try:
+                    return await self._wait(pool, func, *args)
+                except BrokenProcessPool:
+                    # 工作进程挂了（或者被别的超时任务连带杀掉了）：换个新进程池再试一次
+                    print("[水印] 进程池已损坏，重建后重试")
+                    self._restart_pool(pool)
+                    return await self._wait(self.start(), func, *args)
+        finally:
+            self.pending -= 1
+
+    async def _wait(self, pool, func, *args):
+        """执行任务；超时的话确认它真的停了才返回（抛 TimeoutError）"""
+        future = asyncio.get_running_loop().run_in_executor(pool, func, *args)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            if pool is not None:
+                self._restart_pool(pool)
+            # 进程池被关掉后 future 很快就会结束；线程只能等它自己跑完
+            await asyncio.wait({future})
+            if not future.cancelled():
+                future.exception()
+            raise
+
+    async def load(self, file_path: str, file_type: str):
+        return await self._run(False, load_asset, file_path, file_type)
+
+    async def embed(self, asset, file_type: str, file_path: str, tracking_code: str):
+        """打水印写到一个待发送的临时文件里，返回 (临时文件路径, 扩展名)；发完由调用方 discard_delivery"""
+        _, prep, is_card, job_bytes = asset
+        if job_bytes > self.job_limit:
+            raise WatermarkTooLarge(f"预计要用 {job_bytes / 1024 / 1024:.0f} MB 内存")
+        heavy = file_type == "image" and not is_card and not prep
+        out_path = new_delivery_path()
+        try:
+            ext = await self._run(heavy, write_watermarked, asset, file_type, file_path, tracking_code, out_path)
+        except BaseException:
+            discard_delivery(out_path)
+            raise
+        return out_path, ext
+
+    async def extract(self, file_name: str, file_bytes):
+        # 只有 JPEG 这类得整张解码的图片才进进程池；PNG 只读开头几行，JSON 走线程
+        heavy = file_name.lower().endswith(('.png', '.jpg', '.jpeg')) and file_bytes[:8] != PNG_SIGNATURE
+        return await self._run(heavy, extract_watermark, file_name, file_bytes)
+
+    async def prepare(self, source_path: str, file_path: str, file_type: str):
+        """在工作进程里读文件算预处理数据，机器人进程不用拿着整个文件"""
+        return await self._run(file_type in ("image", "json"), prepare_watermark_cache_from, source_path, file_path, file_type)
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+watermark = WatermarkService(WATERMARK_WORKERS, WATERMARK_QUEUE_SIZE, WATERMARK_TIMEOUT, WATERMARK_JOB_MAX_MB * 1024 * 1024)
+
+# ============ 水印任务排队 ============
+
+class RenderLimited(Exception):
+    """这个用户手上的任务已经到上限了"""
+
+class RenderScheduler:
+    """/获取附件 现场打水印前先在这里排队
+
+    同时做的任务数不超过工作进程数，正在做的任务估算内存加起来不超过预算；
+    每人同时最多 per_user 个，排队的人之间轮流来，一个人连点好几次也挤不到别人前面。
+    """
+
+    def __init__(self, slots: int, per_user: int, budget_bytes: int, queue_size: int):
+        self.slots = max(1, slots)
+        self.per_user = per_user
+        self.budget = budget_bytes
+        self.queue_size = queue_size
+        self.waiting = OrderedDict()  # user_id -> deque[(估算内存, Future)]，按轮到的先后排
+        self.in_flight = {}           # user_id -> 排队的加正在做的任务数
+        self.running = 0
+        self.running_bytes = 0
+
+    def queued(self) -> int:
+        return sum(len(jobs) for jobs in self.waiting.values())
+
+    def position(self, started: asyncio.Future) -> int:
+        """排在第几个（从 1 开始）：按轮流的顺序，每轮每人出一个"""
+        queues = list(self.waiting.values())
+        position = 0
+        for round_index in range(max((len(jobs) for jobs in queues), default=0)):
+            for jobs in queues:
+                if round_index < len(jobs):
+                    position += 1
+                    if jobs[round_index][1] is started:
+                        return position
+        return 0
+
+    def _dispatch(self):
+        while self.running < self.slots and self.waiting:
+            user_id, jobs = next(iter(self.waiting.items()))
+            job_bytes, started = jobs[0]
+            # 轮到的任务内存不够就等前面的做完，不让后面的小任务插队（否则大图可能一直轮不上）
+            if self.running and self.running_bytes + job_bytes > self.budget:
+                return
+            jobs.popleft()
+            if jobs:
+                self.waiting.move_to_end(user_id)
+            else:
+                del self.waiting[user_id]
+            self.running += 1
+            self.running_bytes += job_bytes
+            started.set_result(None)
+
+    async def run(self, user_id: int, job_bytes: int, job, on_wait=None):
+        """排队然后执行 job()；排队期间每隔一会儿用当前位置调用一次 on_wait(位置)（位置变了才调用）"""
+        if self.in_flight.get(user_id, 0) >= self.per_user:
+            raise RenderLimited("手上的任务已经到上限了")
+        if self.queued() >= self.queue_size:
+            raise WatermarkBusy("鹅现在忙不过来啦")
+        started = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(user_id, deque()).append((job_bytes, started))
+        self.in_flight[user_id] = self.in_flight.get(user_id, 0) + 1
+        try:
+            self._dispatch()
+            last_position = None
+            while not started.done():
+                position = self.position(started)
+                if on_wait and position != last_position:
+                    last_position = position
+                    await on_wait(position)
+                try:
+                    await asyncio.wait_for(asyncio.shield(started), RENDER_QUEUE_UPDATE_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            if not started.done():
+                # 还在排队就被取消了：从队里拿掉
+                started.cancel()
+                jobs = self.waiting.get(user_id)
+                if jobs is not None:
+                    self.waiting[user_id] = deque(entry for entry in jobs if entry[1] is not started)
+                    if not self.waiting[user_id]:
+                        del self.waiting[user_id]
+                self._release(user_id)
+                raise
+            # 刚轮到就出错（比如 on_wait 发消息失败）：名额照常还回去
+            self._finish(user_id, job_bytes)
+            raise
+        try:
+            return await job()
+        finally:
+            self._finish(user_id, job_bytes)
+
+    def _release(self, user_id: int):
+        count = self.in_flight.get(user_id, 1) - 1
+        if count:
+            self.in_flight[user_id] = count
+        else:
+            self.in_flight.pop(user_id, None)
+
+    def _finish(self, user_id: int, job_bytes: int):
+        self.running -= 1
+        self.running_bytes -= job_bytes
+        self._release(user_id)
+        self._dispatch()
+
+render_scheduler = RenderScheduler(WATERMARK_WORKERS, RENDER_PER_USER, RENDER_BUDGET_MB * 1024 * 1024, WATERMARK_QUEUE_SIZE)
+
+# ============ 预渲染水印副本池 ============
+
+class PrerenderPool:
+    """热门文件提前备好几份带水印的副本，每份预留一个追踪码；请求来了直接领一份
+
+    副本存成待发送目录里的文件，领走的人发完负责删掉。
+    """
+
+    def __init__(self):
+        self.copies = {}    # file_id -> deque[(追踪码, 副本文件路径, 扩展名, 生成时间, 文件大小)]
+        self.requests = {}  # file_id -> deque[请求时间]
+        self.files = {}     # file_id -> (file_path, file_type)
+        self.size = 0
+
+    def note_request(self, file_id: int, file_path: str, file_type: str):
+        """记录一次请求，用来估算需求量"""
+        self.files[file_id] = (file_path, file_type)
+        self.requests.setdefault(file_id, deque()).append(time.monotonic())
+
+    def claim(self, file_id: int):
+        """领一份现成的副本，没有就返回 None"""
+        copies = self.copies.get(file_id)
+        if not copies:
+            return None
+        tracking_code, path, ext, _, size = copies.popleft()
+        self.size -= size
+        return tracking_code, path, ext
+
+    def target_size(self, file_id: int) -> int:
+        """按最近的请求速度决定备几份"""
+        now = time.monotonic()
+        requests = self.requests.get(file_id, deque())
+        while requests and now - requests[0] > PRERENDER_WINDOW:
+            requests.popleft()
+        if len(requests) < PRERENDER_MIN_REQUESTS:
+            return 0
+        return min(PRERENDER_MAX_COPIES, math.ceil(len(requests) * PRERENDER_LEAD_SECONDS / PRERENDER_WINDOW))
+
+    def drop(self, file_id: int):
+        """丢掉某个文件的全部副本（文件被删除时调用），返回要释放的追踪码"""
+        copies = self.copies.pop(file_id, deque())
+        self.requests.pop(file_id, None)
+        self.files.pop(file_id, None)
+        for _, path, _, _, size in copies:
+            discard_delivery(path)
+            self.size -= size
+        return [copy[0] for copy in copies]
+
+    def expire(self, file_id: int):
+        """丢掉过期的副本，返回要释放的追踪码"""
+        copies = self.copies.get(file_id)
+        released = []
+        while copies and time.monotonic() - copies[0][3] > PRERENDER_TTL:
+            code, path, _, _, size = copies.popleft()
+            discard_delivery(path)
+            self.size -= size
+            released.append(code)
+        return released
+
+    async def refill(self):
+        """补货：热门文件补到目标份数，冷掉或过期的副本回收并释放预留的追踪码
+
+        副本一个一个做，最多占一个工作名额；有现场任务在跑或在排队时这一轮就不补了，
+        免得补货把名额和排队位置占满，让 /获取附件 的人碰到「忙不过来」。
+        """
+        released = []
+        for file_id in list(self.files):
+            target = self.target_size(file_id)
+            released.extend(self.expire(file_id))
+            copies = self.copies.setdefault(file_id, deque())
+            while len(copies) > target:
+                code, path, _, _, size = copies.pop()
+                discard_delivery(path)
+                self.size -= size
+                released.append(code)
+            if not target and not self.requests.get(file_id):
+                self.files.pop(file_id, None)
+                self.copies.pop(file_id, None)
+                continue
+            file_path, file_type = self.files[file_id]
+            while len(copies) < target and self.size < PRERENDER_BUDGET_MB * 1024 * 1024:
+                if watermark.pending or render_scheduler.running or render_scheduler.waiting:
+                    break
+                tracking_code = await reserve_tracking_code(file_id)
+                try:
+                    asset = await watermark.load(file_path, file_type)
+                    path, ext = await watermark.embed(asset, file_type, file_path, tracking_code)
+                except Exception as e:
+                    released.append(tracking_code)
+                    print(f"[预渲染] 文件 #{file_id} 生成副本失败：{e}")
+                    break
+                # 渲染期间文件可能被删了
+                if file_id not in self.files:
+                    discard_delivery(path)
+                    released.append(tracking_code)
+                    break
+                size = os.path.getsize(path)
+                copies.append((tracking_code, path, ext, time.monotonic(), size))
+                self.size += size
+        await release_tracking_codes(released)
+
+prerender_pool = PrerenderPool()
+
+async def reserve_tracking_code(file_id: int) -> str:
+    """为预渲染副本预留一个追踪码"""
+    tracking_code = await generate_tracking_code()
+    await db.execute(
+        "INSERT INTO tracking_reservations (tracking_code, file_id, reserved_at) VALUES (?, ?, ?)",
+        (tracking_code, file_id, datetime.now().isoformat())
+    )
+    return tracking_code
+
+def record_tracking(conn, row):
+    """记下谁拿到了哪个追踪码（预留过的顺便转正）"""
+    conn.execute("DELETE FROM tracking_reservations WHERE tracking_code = ?", (row[0],))
+    conn.execute(
+        "INSERT INTO tracking (tracking_code, user_id, user_name, file_id, post_name, file_name, version, retrieved_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        row
+    )
+
+async def release_tracking_codes(tracking_codes):
+    """释放没用上的预留追踪码"""
+    if not tracking_codes:
+        return
+    await db.executemany("DELETE FROM tracking_reservations WHERE tracking_code = ?", [(code,) for code in tracking_codes])
+
+@tasks.loop(seconds=5)
+async def refill_prerender_pool():
+    await prerender_pool.refill()
+
+@refill_prerender_pool.before_loop
+async def before_prerender():
+    await bot.wait_until_ready()
+    # 上次运行的副本文件启动时已经清掉了，留下的预留追踪码都没人能领了，全部回收
+    reclaimed = (await db.execute("DELETE FROM tracking_reservations")).rowcount
+    if reclaimed:
+        print(f"[预渲染] 回收了 {reclaimed} 个上次运行留下的预留追踪码")
+
+# ============ 已发送文件缓存 ============
+
+class RenderedCache:
+    """发给每个人的水印文件在磁盘上留一份，按 (file_id, 追踪码) 找；超出预算时删掉最久没用的
+
+    同一个人再拿同一个文件会沿用第一次的追踪码，所以直接把这份再发一次就行。
+    只在事件循环里用，不用加锁。
+    """
+
+    def __init__(self, directory: str, budget_bytes: int):
+        self.directory = directory
+        self.budget = budget_bytes
+        self.entries = OrderedDict()  # "file_id-追踪码" -> (文件名, 大小)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def restore(self):
+        """启动时按修改时间（用过就会更新）恢复使用顺序"""
+        names = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            names.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(names):
+            self.entries[os.path.splitext(name)[0]] = (name, size)
+            self.size += size
+        self._evict()
+
+    def get(self, file_id: int, tracking_code: str):
+        """有缓存返回 (路径, 扩展名)，没有返回 None"""
+        key = f"{file_id}-{tracking_code}"
+        entry = self.entries.get(key)
+        path = entry and os.path.join(self.directory, entry[0])
+        if entry is None or not os.path.exists(path):
+            self._drop(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        os.utime(path)
+        self.hits += 1
+        return path, os.path.splitext(entry[0])[1]
+
+    def put(self, file_id: int, tracking_code: str, src_path: str, ext: str):
+        """把发完的临时文件挪进缓存"""
+        key = f"{file_id}-{tracking_code}"
+        name = key + ext
+        size = os.path.getsize(src_path)
+        self._drop(key)
+        if size > self.budget:
+            discard_delivery(src_path)
+            return
+        os.replace(src_path, os.path.join(self.directory, name))
+        self.entries[key] = (name, size)
+        self.size += size
+        self._evict()
+
+    def drop_file(self, file_id: int):
+        """文件被删除时丢掉它的所有缓存"""
+        prefix = f"{file_id}-"
+        for key in [key for key in self.entries if key.startswith(prefix)]:
+            self._drop(key)
+
+    def _drop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= entry[1]
+            discard_delivery(os.path.join(self.directory, entry[0]))
+
+    def _evict(self):
+        while self.size > self.budget and self.entries:
+            self._drop(next(iter(self.entries)))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+rendered_cache = RenderedCache(RENDERED_DIR, RENDERED_CACHE_MB * 1024 * 1024)
+if not IN_WORKER_PROCESS:
+    rendered_cache.restore()
+# 正在给谁发哪个文件 {(user_id, file_id)}，同一个人连点两次不会拿到两个追踪码
+deliveries_in_flight = set()
+
+# ============ 帖子附件目录 ============
+
+# 旧文件按帖子名认领用：{帖子名（现在的和审计日志里改名前的）: {帖子 ID}}，启动后列完帖子才有
+legacy_thread_names: dict[str, set[int]] | None = None
+
+def claim_legacy_files(conn, thread_id: int, post_name: str):
+    """把还没记帖子 ID、但帖子名对得上的旧文件归到这个帖子下（同名同版本已存在的跳过）
+
+    还没列完帖子，或者别的帖子也叫（或者叫过）这个名字时不认领，免得先打开的帖子把文件全拿走。
+    """
+    names = legacy_thread_names
+    if names is None or names.get(post_name, set()) - {thread_id}:
+        return
+    conn.execute("UPDATE OR IGNORE files SET thread_id = ? WHERE thread_id IS NULL AND post_name = ?", (thread_id, post_name))
+
+def load_thread_files(conn, thread_id: int, post_name: str):
+    claim_legacy_files(conn, thread_id, post_name)
+    return conn.execute(
+        "SELECT id, file_name, version, file_path, file_type FROM files WHERE thread_id = ? ORDER BY uploaded_at DESC",
+        (thread_id,)
+    ).fetchall()
+
+class ThreadCatalog:
+    """每个帖子的附件目录：{文件名: [(版本, file_id, file_path, file_type), ...]}（版本从新到旧）
+
+    第一次用到某个帖子时查一次数据库，之后选文件、选版本都直接用内存里的；
+    上传、更新、删除附件后作废对应帖子。
+    """
+
+    def __init__(self):
+        self.threads = {}
+
+    async def get(self, thread_id: int, post_name: str) -> dict:
+        catalog = self.threads.get(thread_id)
+        if catalog is None:
+            catalog = {}
+            for file_id, file_name, version, file_path, file_type in await db.run(load_thread_files, thread_id, post_name):
+                catalog.setdefault(file_name, []).append((version, file_id, file_path, file_type))
+            self.threads[thread_id] = catalog
+        return catalog
+
+    def invalidate(self, thread_id: int):
+        self.threads.pop(thread_id, None)
+
+thread_catalog = ThreadCatalog()
+
+async def list_thread_names(guild: discord.Guild) -> dict[str, set[int]]:
+    """列出服务器里的帖子（进行中的和已归档的）现在的名字，再从审计日志补上改名前的名字"""
+    names = {}
+    for thread in await guild.active_threads():
+        names.setdefault(thread.name, set()).add(thread.id)
+    for channel in guild.forums + guild.text_channels:
+        try:
+            async for thread in channel.archived_threads(limit=None):
+                names.setdefault(thread.name, set()).add(thread.id)
+        except discord.Forbidden:
+            continue
+    try:
+        async for entry in guild.audit_logs(limit=None, action=discord.AuditLogAction.thread_update):
+            before = getattr(entry.before, "name", None)
+            if before and before != getattr(entry.after, "name", None):
+                names.setdefault(before, set()).add(entry.target.id)
+    except discord.Forbidden:
+        print("[附件目录] 没有查看审计日志的权限，改过名的旧帖子只能手动认领")
+    return names
+
+async def resolve_legacy_threads():
+    """启动时给还没记帖子 ID 的旧文件找帖子：名字只对得上一个帖子的直接归过去，
+    对不上或者对得上好几个的留着，由管理员用 /认领旧附件 指定
+    """
+    global legacy_thread_names
+    rows = await db.fetchall("SELECT DISTINCT post_name FROM files WHERE thread_id IS NULL")
+    if not rows:
+        legacy_thread_names = {}
+        return
+    guild = bot.get_guild(GUILD_ID)
+    if guild is None:
+        return
+    names = await list_thread_names(guild)
+    legacy_thread_names = names
+    assigned = []
+    unresolved = []
+    for (post_name,) in rows:
+        thread_ids = names.get(post_name, set())
+        if len(thread_ids) == 1:
+            assigned.append((next(iter(thread_ids)), post_name))
+        else:
+            unresolved.append(f"{post_name}（{len(thread_ids)} 个帖子）")
+    if assigned:
+        await db.executemany("UPDATE OR IGNORE files SET thread_id = ? WHERE thread_id IS NULL AND post_name = ?", assigned)
+        for thread_id, _ in assigned:
+            thread_catalog.invalidate(thread_id)
+            participation_threads.add(thread_id)
+        print(f"[附件目录] 旧文件按帖子名归档了 {len(assigned)} 个帖子")
+    if unresolved:
+        print(f"[附件目录] ⚠️ 这些旧帖子名找不到唯一的帖子，需要用 /认领旧附件 手动指定：{'、'.join(unresolved)}")
+
+# ============ 文件仓库维护 ============
+
+async def prepare_upload(tmp_path: str, file_path: str, file_type: str):
+    """第一次见到的内容顺便生成水印预处理缓存（直接从下载好的临时文件算）"""
+    if file_type not in ("image", "json") or os.path.exists(watermark_cache_path(file_path)):
+        return
+    try:
+        await watermark.prepare(tmp_path, file_path, file_type)
+    except Exception as e:
+        print(f"[水印缓存] 预处理 {file_path} 失败：{e}")
+
+def relink_file_row(conn, file_id: int, old_path: str, new_path: str, content_hash: str) -> bool:
+    """把旧文件的记录指到仓库里，旧文件没人用了就删掉"""
+    conn.execute("UPDATE files SET file_path = ?, content_hash = ? WHERE id = ?", (new_path, content_hash, file_id))
+    return release_file(conn, old_path)
+
+def move_legacy_file(old_path: str, ext: str):
+    """把旧目录里的文件搬进仓库，返回 (内容哈希, 新路径)；旧文件不见了返回 None"""
+    if not os.path.exists(old_path):
+        return None
+    with open(old_path, 'rb') as f:
+        file_bytes = f.read()
+    content_hash, new_path = put_blob(file_bytes, ext)
+    # 水印预处理缓存跟着内容走，能沿用就沿用
+    old_cache, new_cache = watermark_cache_path(old_path), watermark_cache_path(new_path)
+    if os.path.exists(old_cache) and not os.path.exists(new_cache):
+        os.replace(old_cache, new_cache)
+    return content_hash, new_path
+
+async def migrate_legacy_files() -> int:
+    """把还存在旧目录（帖子名/帖子ID）里的文件搬进仓库，返回搬了几个"""
+    rows = await db.fetchall("SELECT id, thread_id, file_path FROM files WHERE content_hash IS NULL")
+    moved = 0
+    for file_id, thread_id, old_path in rows:
+        try:
+            result = await asyncio.to_thread(move_legacy_file, old_path, os.path.splitext(old_path)[1])
+        except Exception as e:
+            print(f"[文件仓库] 搬运 {old_path} 失败：{e}")
+            continue
+        if result is None:
+            continue
+        content_hash, new_path = result
+        if await db.run(relink_file_row, file_id, old_path, new_path, content_hash):
+            asset_cache.invalidate(old_path)
+            try:
+                os.rmdir(os.path.dirname(old_path))  # 目录空了就顺手删掉
+            except OSError:
+                pass
+        thread_catalog.invalidate(thread_id)
+        await release_tracking_codes(prerender_pool.drop(file_id))
+        moved += 1
+    return moved
+
+def find_unreferenced_blobs(referenced: set):
+    """扫描仓库，找出没有记录指向、而且过了保护期的文件（含水印缓存和残留的临时文件）"""
+    now = time.time()
+    candidates = []
+    for root, _, names in os.walk(BLOBS_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            if name.endswith(".tmp"):
+                base = None
+            elif name.endswith(".wm"):
+                base = path[:-len(".wm")]
+            else:
+                base = path
+            if base in referenced:
+                continue
+            try:
+                if now - os.path.getmtime(path) < BLOB_GRACE_SECONDS:
+                    continue
+            except OSError:
+                continue
+            candidates.append((path, base))
+    return candidates
+
+def remove_unreferenced_blobs(conn, candidates) -> int:
+    """在数据库线程上再确认一遍引用数再删（和上传记录文件排在同一个线程上，不会删掉刚被引用的）"""
+    removed = 0
+    for path, base in candidates:
+        if base is not None and conn.execute("SELECT 1 FROM files WHERE file_path = ?", (base,)).fetchone():
+            continue
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+async def collect_blob_garbage() -> int:
+    """删掉仓库里没人引用的文件，返回删了几个"""
+    rows = await db.fetchall("SELECT file_path FROM files")
+    candidates = await asyncio.to_thread(find_unreferenced_blobs, {row[0] for row in rows})
+    if not candidates:
+        return 0
+    return await db.run(remove_unreferenced_blobs, candidates)
+
+@tasks.loop(hours=24)
+async def maintain_file_store():
+    """每天整理一次：搬运旧文件，清理没人引用的文件"""
+    moved = await migrate_legacy_files()
+    if moved:
+        print(f"[文件仓库] 已把 {moved} 个旧文件搬进仓库")
+    removed = await collect_blob_garbage()
+    if removed:
+        print(f"[文件仓库] 清理了 {removed} 个没人引用的文件")
+
+@maintain_file_store.before_loop
+async def before_maintain_file_store():
+    await bot.wait_until_ready()
+
 # ============ 抽奖工具函数 ============
 def parse_duration(duration_str: str) -> timedelta | None:
     if not duration_str:
@@ -357,19 +2312,21 @@ def parse_duration(duration_str: str) -> timedelta | None:
 
 async def do_lottery_draw(bot_instance, lottery_id: int):
     """执行抽奖开奖（定时和手动共用）"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT guild_id, channel_id, message_id, title, prize, winner_count, required_role_id, created_by FROM lotteries WHERE id = ? AND status = 'active'", (lottery_id,))
-    lottery = c.fetchone()
+    def close_lottery(conn):
+        c = conn.cursor()
+        c.execute("SELECT guild_id, channel_id, message_id, title, prize, winner_count, required_role_id, created_by FROM lotteries WHERE id = ? AND status = 'active'", (lottery_id,))
+        lottery = c.fetchone()
+        if not lottery:
+            return None, []
+        c.execute("SELECT user_id FROM lottery_entries WHERE lottery_id = ?", (lottery_id,))
+        entries = [row[0] for row in c.fetchall()]
+        c.execute("UPDATE lotteries SET status = 'ended', ended_at = ? WHERE id = ?", (datetime.now().isoformat(), lottery_id))
+        return lottery, entries
+
+    lottery, entries = await db.run(close_lottery)
     if not lottery:
-        conn.close()
         return None
     guild_id, channel_id, message_id, title, prize, winner_count, required_role_id, created_by = lottery
-    c.execute("SELECT user_id FROM lottery_entries WHERE lottery_id = ?", (lottery_id,))
-    entries = [row[0] for row in c.fetchall()]
-    c.execute("UPDATE lotteries SET status = 'ended', ended_at = ? WHERE id = ?", (datetime.now().isoformat(), lottery_id))
-    conn.commit()
-    conn.close()
 
     if not entries:
         winners = []
@@ -425,14 +2382,135 @@ async def do_lottery_draw(bot_instance, lottery_id: int):
 
 async def _lottery_timer(bot_instance, lottery_id: int, delay_seconds: float):
     await asyncio.sleep(delay_seconds)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT status FROM lotteries WHERE id = ?", (lottery_id,))
-    result = c.fetchone()
-    conn.close()
+    result = await db.fetchone("SELECT status FROM lotteries WHERE id = ?", (lottery_id,))
     if result and result[0] == 'active':
         await do_lottery_draw(bot_instance, lottery_id)
 
+async def join_lottery(lottery_id: int, user_id: int) -> int:
+    """报名抽奖（重复报名抛 IntegrityError），返回报名后的参与人数"""
+    await db.write("INSERT INTO lottery_entries (lottery_id, user_id, entered_at) VALUES (?, ?, ?)",
+                   (lottery_id, user_id, datetime.now().isoformat()))
+    result = await db.fetchone("SELECT COUNT(*) FROM lottery_entries WHERE lottery_id = ?", (lottery_id,))
+    return result[0]
+
+# ============ 分页下拉菜单 ============
+# Discord 一个下拉菜单最多 25 个选项。PagedSelectView 每次只取一页，按键翻页：
+# 只记每一页开头之前的那个键（上一页就是弹出一个键），不缓存整张列表，也不用 OFFSET。
+SELECT_PAGE_SIZE = 25
+
+class PagedSearchModal(discord.ui.Modal, title="搜索"):
+    keyword = discord.ui.TextInput(label="关键词（留空显示全部）", required=False, max_length=100)
+
+    def __init__(self, view: "PagedSelectView"):
+        super().__init__()
+        self.view = view
+        self.keyword.default = view.query
+
+    async def on_submit(self, interaction: discord.Interaction):
+        self.view.query = self.keyword.value.strip() or None
+        self.view.starts = [None]
+        await self.view.load()
+        await self.view.refresh(interaction)
+
+class PagedSelectView(discord.ui.View):
+    """分页下拉菜单
+
+    fetch(after, query, limit) 返回按键升序、键大于 after 的前 limit 条 [(键, SelectOption, 附带数据)]，
+    after 为 None 表示从头开始，query 是搜索关键词（没有搜索时为 None）。
+    on_select(interaction, values) 处理选中的值；render(entries) 可以给当前页生成一个 embed。
+    用之前先 await load() 取第一页。
+    """
+
+    def __init__(self, fetch, on_select, placeholder: str, *, timeout: float = 60, max_values: int = 1, render=None):
+        super().__init__(timeout=timeout)
+        self.fetch = fetch
+        self.on_select = on_select
+        self.placeholder = placeholder
+        self.max_values = max_values
+        self.render = render
+        self.query = None
+        self.starts = [None]
+        self.entries = []
+        self.has_next = False
+
+    async def load(self):
+        # 多取一条，看看后面还有没有下一页
+        rows = await self.fetch(self.starts[-1], self.query, SELECT_PAGE_SIZE + 1)
+        self.has_next = len(rows) > SELECT_PAGE_SIZE
+        self.entries = rows[:SELECT_PAGE_SIZE]
+        self.rebuild()
+
+    def rebuild(self):
+        self.clear_items()
+        if self.entries:
+            select = discord.ui.Select(
+                placeholder=self.placeholder,
+                options=[option for _, option, _ in self.entries],
+                max_values=min(self.max_values, len(self.entries)),
+                row=0
+            )
+            select.callback = lambda interaction: self.on_select(interaction, select.values)
+        else:
+            select = discord.ui.Select(
+                placeholder="👂 没有找到符合的…换个关键词试试吧",
+                options=[discord.SelectOption(label="-", value="-")],
+                disabled=True,
+                row=0
+            )
+        self.add_item(select)
+
+        # 只有一页、也没在搜索的时候就不放翻页按钮了
+        if len(self.starts) == 1 and not self.has_next and self.query is None:
+            return
+        prev_button = discord.ui.Button(label="◀ 上一页", style=discord.ButtonStyle.secondary, disabled=len(self.starts) == 1, row=1)
+        prev_button.callback = self.prev_page
+        page_label = discord.ui.Button(label=f"第 {len(self.starts)} 页", style=discord.ButtonStyle.secondary, disabled=True, row=1)
+        next_button = discord.ui.Button(label="下一页 ▶", style=discord.ButtonStyle.secondary, disabled=not self.has_next, row=1)
+        next_button.callback = self.next_page
+        search_button = discord.ui.Button(label="🔍 搜索", style=discord.ButtonStyle.primary, row=1)
+        search_button.callback = self.search
+        for item in (prev_button, page_label, next_button, search_button):
+            self.add_item(item)
+
+    def message_kwargs(self) -> dict:
+        kwargs = {"view": self}
+        if self.render:
+            kwargs["embed"] = self.render(self.entries)
+        return kwargs
+
+    async def refresh(self, interaction: discord.Interaction):
+        await interaction.response.edit_message(**self.message_kwargs())
+
+    async def prev_page(self, interaction: discord.Interaction):
+        if len(self.starts) > 1:
+            self.starts.pop()
+        await self.load()
+        await self.refresh(interaction)
+
+    async def next_page(self, interaction: discord.Interaction):
+        if self.has_next:
+            self.starts.append(self.entries[-1][0])
+        await self.load()
+        await self.refresh(interaction)
+
+    async def search(self, interaction: discord.Interaction):
+        await interaction.response.send_modal(PagedSearchModal(self))
+
+def paged_options(options: list[discord.SelectOption]):
+    """把内存里已经排好序的选项包成 PagedSelectView 的 fetch，键是选项的位置，按标签和说明搜索"""
+    async def fetch(after, query, limit):
+        keyword = query.casefold() if query else None
+        rows = []
+        for index in range(0 if after is None else after + 1, len(options)):
+            option = options[index]
+            if keyword and keyword not in option.label.casefold() and keyword not in (option.description or "").casefold():
+                continue
+            rows.append((index, option, None))
+            if len(rows) >= limit:
+                break
+        return rows
+    return fetch
+
 # ============ 抽奖按钮 View ============
 class LotteryJoinView(discord.ui.View):
     def __init__(self, lottery_id: int, required_role_id: int | None = None):
@@ -443,12 +2521,8 @@ class LotteryJoinView(discord.ui.View):
     @discord.ui.button(label="🎰 参加抽奖！", style=discord.ButtonStyle.success, custom_id="lottery_join")
     async def join_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         user = interaction.user
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT status, required_role_id FROM lotteries WHERE id = ?", (self.lottery_id,))
-        result = c.fetchone()
+        result = await db.fetchone("SELECT status, required_role_id FROM lotteries WHERE id = ?", (self.lottery_id,))
         if not result or result[0] != 'active':
-            conn.close()
             await interaction.response.send_message("👂 这个抽奖已经结束啦～下次早点来哦", ephemeral=True)
             return
         req_role_id = result[1]
@@ -457,22 +2531,14 @@ class LotteryJoinView(discord.ui.View):
             if member and not any(r.id == req_role_id for r in member.roles):
                 role = interaction.guild.get_role(req_role_id)
                 role_name = role.name if role else "指定身份组"
-                conn.close()
                 await interaction.response.send_message(f"👂 需要拥有 **{role_name}** 身份组才能参加哦～", ephemeral=True)
                 return
         try:
-            c.execute("INSERT INTO lottery_entries (lottery_id, user_id, entered_at) VALUES (?, ?, ?)",
-                      (self.lottery_id, user.id, datetime.now().isoformat()))
-            conn.commit()
-            c.execute("SELECT COUNT(*) FROM lottery_entries WHERE lottery_id = ?", (self.lottery_id,))
-            count = c.fetchone()[0]
-            conn.close()
+            count = await join_lottery(self.lottery_id, user.id)
             await interaction.response.send_message(f"🎉 报名成功！你是第 **{count}** 位参与者～祝你好运！🍀", ephemeral=True)
         except sqlite3.IntegrityError:
-            conn.close()
             await interaction.response.send_message("👂 你已经报名过啦～不用重复参加哦", ephemeral=True)
         except Exception as e:
-            conn.close()
             await interaction.response.send_message(f"👂 报名出了点问题：{str(e)}", ephemeral=True)
 
 # ============ 持久化 View（Bot重启后按钮仍可用） ============
@@ -482,11 +2548,7 @@ class PersistentLotteryView(discord.ui.View):
 
     @discord.ui.button(label="🎰 参加抽奖！", style=discord.ButtonStyle.success, custom_id="lottery_join")
     async def join_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT id, status, required_role_id FROM lotteries WHERE message_id = ?", (interaction.message.id,))
-        result = c.fetchone()
-        conn.close()
+        result = await db.fetchone("SELECT id, status, required_role_id FROM lotteries WHERE message_id = ?", (interaction.message.id,))
         if not result:
             await interaction.response.send_message("👂 找不到这个抽奖了…", ephemeral=True)
             return
@@ -501,18 +2563,10 @@ class PersistentLotteryView(discord.ui.View):
                 role_name = role.name if role else "指定身份组"
                 await interaction.response.send_message(f"👂 需要拥有 **{role_name}** 身份组才能参加哦～", ephemeral=True)
                 return
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
         try:
-            c.execute("INSERT INTO lottery_entries (lottery_id, user_id, entered_at) VALUES (?, ?, ?)",
-                      (lottery_id, interaction.user.id, datetime.now().isoformat()))
-            conn.commit()
-            c.execute("SELECT COUNT(*) FROM lottery_entries WHERE lottery_id = ?", (lottery_id,))
-            count = c.fetchone()[0]
-            conn.close()
+            count = await join_lottery(lottery_id, interaction.user.id)
             await interaction.response.send_message(f"🎉 报名成功！你是第 **{count}** 位参与者～祝你好运！🍀", ephemeral=True)
         except sqlite3.IntegrityError:
-            conn.close()
             await interaction.response.send_message("👂 你已经报名过啦～不用重复参加哦", ephemeral=True)
     
 # ============ Bot 启动事件 ============
@@ -525,13 +2579,23 @@ async def on_ready():
     
     if not refresh_anon_nicknames.is_running():
         refresh_anon_nicknames.start()
+    if not refill_prerender_pool.is_running():
+        refill_prerender_pool.start()
+    if not maintain_file_store.is_running():
+        maintain_file_store.start()
+    # 还没记帖子 ID 的旧文件按帖子名归档
+    asyncio.create_task(resolve_legacy_threads())
+
+    # 断线期间的消息和点赞没收到事件：每个帖子都要再补一遍
+    participation_backfilled.clear()
+    reaction_backfilled.clear()
+    if not crawl_thread_participation.is_running():
+        crawl_thread_participation.start()
+    else:
+        crawl_thread_participation.restart()
 
     # ========== 恢复未结束的定时抽奖 ==========
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, end_time FROM lotteries WHERE status = 'active' AND end_time IS NOT NULL")
-    pending = c.fetchall()
-    conn.close()
+    pending = await db.fetchall("SELECT id, end_time FROM lotteries WHERE status = 'active' AND end_time IS NOT NULL")
     for lottery_id, end_time_str in pending:
         try:
             end_dt = datetime.fromisoformat(end_time_str)
@@ -546,11 +2610,7 @@ async def on_ready():
         print(f"[抽奖恢复] 已恢复 {len(pending)} 个定时抽奖")
 
     # ========== 恢复订阅面板 ==========
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT message_id, channel_id, guild_id, role_ids FROM subscribe_panels")
-    panels = c.fetchall()
-    conn.close()
+    panels = await db.fetchall("SELECT message_id, channel_id, guild_id, role_ids FROM subscribe_panels")
     for msg_id, ch_id, g_id, role_ids_json in panels:
         try:
             role_ids = json.loads(role_ids_json)
@@ -568,11 +2628,7 @@ async def on_ready():
         print(f"[订阅面板恢复] 已恢复 {len(panels)} 个订阅面板")
 
     # ========== 恢复临时身份组定时器 ==========
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, guild_id, user_id, role_id, expire_at FROM temp_roles WHERE status = 'active'")
-    temp_entries = c.fetchall()
-    conn.close()
+    temp_entries = await db.fetchall("SELECT id, guild_id, user_id, role_id, expire_at FROM temp_roles WHERE status = 'active'")
     for tr_id, g_id, u_id, r_id, expire_at_str in temp_entries:
         try:
             expire_dt = datetime.fromisoformat(expire_at_str)
@@ -633,9 +2689,12 @@ async def help_command(ctx):
         "🔧 **管理员专属：**\n"
         "`/上传附件` - 往仓库里放文件\n"
         "`/更新附件` - 给文件换个新版本\n"
+        "`/批量上传附件` - 上传压缩包，一次放进很多文件\n"
         "`/验证水印` - 用水印追踪泄露者\n"
+        "`/批量验证水印` - 一次验证一个压缩包或多个文件\n"
         "`/查看记录` - 看看谁拿了什么文件\n"
         "`/删除附件` - 从仓库删掉文件\n"
+        "`/缓存状态` - 看看热门文件缓存的命中情况\n"
         "`/设置匿名频道` - 开一个匿名区\n"
         "`/取消匿名频道` - 关掉匿名区\n"
         "`/查看匿名身份` - 看看匿名的人是谁\n"
@@ -719,34 +2778,30 @@ async def upload_file(interaction: discord.Interaction, 帖子链接: str, 文
         await interaction.followup.send(f"👂 链接好像不对呀…鹅打不开这扇门\n错误信息：{str(e)}", ephemeral=True)
         return
 
-    # 确定文件类型
-    if 文件.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-        file_type = "image"
-    elif 文件.filename.lower().endswith('.json'):
-        file_type = "json"
-    else:
-        file_type = "other"
-
-    # 创建存储目录（名称过长时用帖子ID）
-    folder_name = post_name if len(post_name.encode('utf-8')) <= 100 else str(thread_id)
-    post_dir = os.path.join(FILES_DIR, folder_name)
-    os.makedirs(post_dir, exist_ok=True)
+    # 同名同版本已经有了就别覆盖原文件
+    catalog = await thread_catalog.get(thread_id, post_name)
+    if any(ver == 版本 for ver, *_ in catalog.get(文件名, [])):
+        await interaction.followup.send(f"👂 这个帖子下已经有同名同版本的文件啦：{文件名} {版本}", ephemeral=True)
+        return
 
-    # 保存文件
-    file_path = os.path.join(post_dir, f"{文件名}_{版本}{os.path.splitext(文件.filename)[1]}")
-    file_bytes = await 文件.read()
-    with open(file_path, 'wb') as f:
-        f.write(file_bytes)
+    # 边下载边写盘、算哈希，按文件开头的魔数认类型
+    try:
+        tmp_path, content_hash, file_type, ext = await ingest_attachment(文件)
+    except UnsupportedUpload as e:
+        await interaction.followup.send(f"👂 {e}，检查一下文件再传吧", ephemeral=True)
+        return
+    except Exception as e:
+        await interaction.followup.send(f"👂 文件没收下来…再试一次吧\n错误信息：{str(e)}", ephemeral=True)
+        return
+    # 存进内容寻址仓库，内容相同的不会重复占空间
+    file_path = blob_path(content_hash, ext)
+    await prepare_upload(tmp_path, file_path, file_type)
 
     # 记录到数据库
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     try:
-        c.execute(
-            "INSERT INTO files (post_name, file_name, version, file_path, file_type, uploaded_by, uploaded_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (post_name, 文件名, 版本, file_path, file_type, interaction.user.id, datetime.now().isoformat())
-        )
-        conn.commit()
+        await db.run(insert_file_row, tmp_path, (thread_id, post_name, 文件名, 版本, file_path, file_type, interaction.user.id, content_hash))
+        thread_catalog.invalidate(thread_id)
+        participation_threads.add(thread_id)
         await interaction.followup.send(
             f"👂 塞进仓库了！\n"
             f"📁 帖子：{post_name}\n"
@@ -755,20 +2810,269 @@ async def upload_file(interaction: discord.Interaction, 帖子链接: str, 文
             f"📦 类型：{file_type}",
             ephemeral=True
         )
-    except sqlite3.IntegrityError:
-        await interaction.followup.send(f"👂 这个帖子下已经有同名同版本的文件啦：{文件名} {版本}", ephemeral=True)
-    finally:
-        conn.close()
+    except sqlite3.IntegrityError:
+        await interaction.followup.send(f"👂 这个帖子下已经有同名同版本的文件啦：{文件名} {版本}", ephemeral=True)
+    finally:
+        discard_ingested(tmp_path)  # 已经放进仓库的话这里什么也不做
+
+# ============ 管理员：更新附件 ============
+@bot.tree.command(name="更新附件", description="【管理员】为已有文件上传新版本")
+@app_commands.describe(
+    帖子链接="帖子的链接（右键帖子→复制链接）",
+    文件名="要更新的文件名称",
+    新版本="新的版本号（如：v2.0）",
+    文件="新版本的文件"
+)
+async def update_file(interaction: discord.Interaction, 帖子链接: str, 文件名: str, 新版本: str, 文件: discord.Attachment):
+    if not is_admin(interaction):
+        await interaction.response.send_message("👂 这个只有管理员才能用哦～鹅也没办法呀", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+
+    # 从链接解析帖子ID
+    try:
+        parts = 帖子链接.strip().split('/')
+        thread_id = int(parts[-1])
+        thread = bot.get_channel(thread_id) or await bot.fetch_channel(thread_id)
+        post_name = thread.name
+    except Exception:
+        await interaction.followup.send("👂 链接好像不对哦～右键帖子→复制链接，再给鹅看看吧", ephemeral=True)
+        return
+
+    catalog = await thread_catalog.get(thread_id, post_name)
+    if any(ver == 新版本 for ver, *_ in catalog.get(文件名, [])):
+        await interaction.followup.send(f"👂 版本 {新版本} 已经存在了，换个版本号吧！", ephemeral=True)
+        return
+
+    # 边下载边写盘、算哈希，按文件开头的魔数认类型
+    try:
+        tmp_path, content_hash, file_type, ext = await ingest_attachment(文件)
+    except UnsupportedUpload as e:
+        await interaction.followup.send(f"👂 {e}，检查一下文件再传吧", ephemeral=True)
+        return
+    except Exception as e:
+        await interaction.followup.send(f"👂 文件没收下来…再试一次吧\n错误信息：{str(e)}", ephemeral=True)
+        return
+    # 存进内容寻址仓库，内容相同的不会重复占空间
+    file_path = blob_path(content_hash, ext)
+    await prepare_upload(tmp_path, file_path, file_type)
+
+    try:
+        await db.run(insert_file_row, tmp_path, (thread_id, post_name, 文件名, 新版本, file_path, file_type, interaction.user.id, content_hash))
+        thread_catalog.invalidate(thread_id)
+        participation_threads.add(thread_id)
+        await interaction.followup.send(
+            f"👂 更新好了！\n"
+            f"📁 帖子：{post_name}\n"
+            f"📄 文件：{文件名}\n"
+            f"🏷️ 新版本：{新版本}",
+            ephemeral=True
+        )
+    except sqlite3.IntegrityError:
+        await interaction.followup.send(f"👂 版本 {新版本} 已经存在了，换个版本号吧！", ephemeral=True)
+    finally:
+        discard_ingested(tmp_path)
+
+# ============ 管理员：批量上传附件 ============
+BULK_IMPORT_MANIFEST = "manifest.json"
+
+def read_bulk_manifest(manifest):
+    """检查清单格式，返回 ([(路径, 文件名, 版本)], [(路径, 原因)])；整份清单格式不对抛 ValueError"""
+    if not isinstance(manifest, dict):
+        raise ValueError("清单最外层得是一个对象")
+    if not isinstance(manifest.get("version") or "", str):
+        raise ValueError("清单里的 version 得是字符串")
+    items = manifest.get("files", [])
+    if not isinstance(items, list):
+        raise ValueError("清单里的 files 得是一个列表")
+    wanted = []
+    failed = []
+    for index, item in enumerate(items, 1):
+        if not isinstance(item, dict):
+            failed.append((f"清单第 {index} 项", "这一项不是对象"))
+        elif not isinstance(item.get("path"), str) or not item["path"]:
+            failed.append((f"清单第 {index} 项", "缺少 path，或者 path 不是字符串"))
+        elif not all(isinstance(item.get(key) or "", str) for key in ("name", "version")):
+            failed.append((item["path"], "name 和 version 得是字符串"))
+        else:
+            wanted.append((item["path"], item.get("name"), item.get("version")))
+    return wanted, failed
+
+def plan_bulk_import(zip_path: str, default_version: str | None):
+    """读清单（没有清单就按路径推断），返回 ([(压缩包内路径, 文件名, 版本)], [(压缩包内路径, 原因)])
+
+    清单格式：{"version": "默认版本", "files": [{"path": "...", "name": "...", "version": "..."}]}
+    没有清单时：「文件名/版本/xxx.png」或「文件名_版本.png」，都不是就用指令里填的版本。
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        infos = {info.filename: info for info in zf.infolist()
+                 if not info.is_dir() and not info.filename.startswith("__MACOSX/") and not os.path.basename(info.filename).startswith(".")}
+        if BULK_IMPORT_MANIFEST in infos:
+            manifest = json.loads(zf.read(BULK_IMPORT_MANIFEST).decode('utf-8-sig'))
+            wanted, failed = read_bulk_manifest(manifest)
+            default_version = manifest.get("version") or default_version
+        else:
+            wanted, failed = [(path, None, None) for path in infos], []
+
+    entries = []
+    seen = set()
+    for path, name, version in wanted:
+        info = infos.get(path)
+        if info is None:
+            failed.append((path, "压缩包里没有这个文件"))
+            continue
+        if not name:
+            parts = path.split("/")
+            stem = os.path.splitext(parts[-1])[0]
+            if len(parts) >= 3:
+                name, version = parts[-3], version or parts[-2]
+            elif "_" in stem:
+                name, derived_version = stem.rsplit("_", 1)
+                version = version or derived_version
+            else:
+                name = stem
+        version = version or default_version
+        if not version:
+            failed.append((path, "不知道是哪个版本（在清单里写上，或者指令里填默认版本）"))
+        elif info.file_size > BULK_IMPORT_MAX_MB * 1024 * 1024:
+            failed.append((path, "文件太大"))
+        elif (name, version) in seen:
+            failed.append((path, f"和压缩包里另一个文件重复：{name} ({version})"))
+        elif len(entries) >= BULK_IMPORT_MAX_FILES:
+            failed.append((path, f"超过 {BULK_IMPORT_MAX_FILES} 个文件上限"))
+        else:
+            seen.add((name, version))
+            entries.append((path, name, version))
+    return entries, failed
+
+def extract_zip_member(zip_path: str, member: str):
+    """把压缩包里的一个文件分块解压到仓库的临时文件，返回 (临时文件路径, 内容哈希, file_type, 扩展名)"""
+    tmp_path = new_ingest_path()
+    digest = hashlib.sha256()
+    head = b""
+    size = 0
+    try:
+        with zipfile.ZipFile(zip_path) as zf, zf.open(member) as src, open(tmp_path, 'wb') as dst:
+            while chunk := src.read(INGEST_CHUNK_BYTES):
+                size += len(chunk)
+                # 文件头里写的大小可能是假的，按实际解压出来的算
+                if size > BULK_IMPORT_MAX_MB * 1024 * 1024:
+                    raise ValueError("文件太大")
+                head = extend_sniff_head(head, chunk)
+                digest.update(chunk)
+                dst.write(chunk)
+            dst.flush()
+            os.fsync(dst.fileno())
+        file_type, ext = sniff_file_type(head, member)
+    except BaseException:
+        discard_ingested(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), file_type, ext
+
+@bot.tree.command(name="批量上传附件", description="【管理员】上传一个压缩包，把里面的文件一次性放进帖子")
+@app_commands.describe(
+    帖子链接="帖子的链接（右键帖子→复制链接）",
+    压缩包="包含所有文件的 .zip（可以带 manifest.json 写明每个文件的名称和版本）",
+    版本="默认版本号（清单和路径里都没写版本的文件用这个）"
+)
+async def bulk_upload_files(interaction: discord.Interaction, 帖子链接: str, 压缩包: discord.Attachment, 版本: str = None):
+    if not is_admin(interaction):
+        await interaction.response.send_message("👂 这个只有管理员才能用哦～鹅也没办法呀", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+
+    # 从链接解析帖子ID（整个压缩包只查一次）
+    try:
+        parts = 帖子链接.strip().split('/')
+        thread_id = int(parts[-1])
+        thread = bot.get_channel(thread_id) or await bot.fetch_channel(thread_id)
+        post_name = thread.name
+    except Exception:
+        await interaction.followup.send("👂 链接好像不对哦～右键帖子→复制链接，再给鹅看看吧", ephemeral=True)
+        return
+
+    # 压缩包本身也是边下载边写盘
+    try:
+        zip_path, _, _, _ = await ingest_attachment(压缩包)
+    except Exception as e:
+        await interaction.followup.send(f"👂 压缩包没收下来…再试一次吧\n错误信息：{str(e)}", ephemeral=True)
+        return
+
+    tmp_paths = []
+    try:
+        try:
+            entries, failed = await asyncio.to_thread(plan_bulk_import, zip_path, 版本)
+        except (zipfile.BadZipFile, ValueError, KeyError) as e:
+            await interaction.followup.send(f"👂 压缩包或清单打不开：{str(e)}", ephemeral=True)
+            return
+
+        catalog = await thread_catalog.get(thread_id, post_name)
+        existing = {(name, ver) for name, versions in catalog.items() for ver, *_ in versions}
+        skipped = [(path, f"已经有 {name} ({ver}) 了") for path, name, ver in entries if (name, ver) in existing]
+        entries = [entry for entry in entries if (entry[1], entry[2]) not in existing]
+
+        # 几个文件同时解压、算哈希、生成水印预处理缓存
+        semaphore = asyncio.Semaphore(BULK_IMPORT_CONCURRENCY)
+
+        async def stage(path, name, ver):
+            async with semaphore:
+                try:
+                    tmp_path, content_hash, file_type, ext = await asyncio.to_thread(extract_zip_member, zip_path, path)
+                except Exception as e:
+                    return path, name, ver, None, str(e)
+                tmp_paths.append(tmp_path)
+                file_path = blob_path(content_hash, ext)
+                await prepare_upload(tmp_path, file_path, file_type)
+                row = (thread_id, post_name, name, ver, file_path, file_type, interaction.user.id, content_hash)
+                return path, name, ver, (tmp_path, row), None
+
+        staged = await asyncio.gather(*(stage(*entry) for entry in entries))
+        failed.extend((path, error) for path, _, _, item, error in staged if item is None)
+        staged = [s for s in staged if s[3] is not None]
+
+        # 所有记录一个事务写进去
+        inserted = await db.run(insert_file_rows, [item for _, _, _, item, _ in staged]) if staged else []
+        thread_catalog.invalidate(thread_id)
+        participation_threads.add(thread_id)
+    finally:
+        for path in [zip_path] + tmp_paths:
+            discard_ingested(path)  # 已经放进仓库的临时文件这里什么也不做
+
+    imported = []
+    for (path, name, ver, (_, row), _), ok in zip(staged, inserted):
+        if ok:
+            imported.append(f"✅ {path} → {name} ({ver}) [{row[5]}]")
+        else:
+            skipped.append((path, f"已经有 {name} ({ver}) 了"))
+
+    lines = [f"👂 **批量上传结果：** 帖子「{post_name}」放进了 {len(imported)} 个文件，跳过 {len(skipped)} 个，失败 {len(failed)} 个\n"]
+    lines.extend(imported)
+    if skipped:
+        lines.append("\n⏭️ **跳过：**")
+        lines.extend(f"　{path}（{reason}）" for path, reason in skipped)
+    if failed:
+        lines.append("\n❌ **失败：**")
+        lines.extend(f"　{path}（{reason}）" for path, reason in failed)
+    report = "\n".join(lines)
+
+    if len(report) <= 1900:
+        await interaction.followup.send(report, ephemeral=True)
+    else:
+        await interaction.followup.send(
+            lines[0] + "\n📎 完整报告在附件里哦",
+            file=discord.File(io.BytesIO(report.encode('utf-8')), filename="bulk_upload_report.txt"),
+            ephemeral=True
+        )
 
-# ============ 管理员：更新附件 ============
-@bot.tree.command(name="更新附件", description="【管理员】为已有文件上传新版本")
+# ============ 管理员：认领旧附件 ============
+@bot.tree.command(name="认领旧附件", description="【管理员】把按旧帖子名存的附件归到指定帖子下")
 @app_commands.describe(
     帖子链接="帖子的链接（右键帖子→复制链接）",
-    文件名="要更新的文件名称",
-    新版本="新的版本号（如：v2.0）",
-    文件="新版本的文件"
+    旧帖子名="上传时帖子的名字（帖子改过名、或者有同名帖子时用）"
 )
-async def update_file(interaction: discord.Interaction, 帖子链接: str, 文件名: str, 新版本: str, 文件: discord.Attachment):
+async def claim_legacy_post(interaction: discord.Interaction, 帖子链接: str, 旧帖子名: str):
     if not is_admin(interaction):
         await interaction.response.send_message("👂 这个只有管理员才能用哦～鹅也没办法呀", ephemeral=True)
         return
@@ -779,48 +3083,24 @@ async def update_file(interaction: discord.Interaction, 帖子链接: str, 文
     try:
         parts = 帖子链接.strip().split('/')
         thread_id = int(parts[-1])
-        thread = bot.get_channel(thread_id) or await bot.fetch_channel(thread_id)
-        post_name = thread.name
-    except Exception:
-        await interaction.followup.send("👂 链接好像不对哦～右键帖子→复制链接，再给鹅看看吧", ephemeral=True)
+        thread = bot.get_channel(thread_id)
+        if thread is None:
+            thread = await bot.fetch_channel(thread_id)
+    except Exception as e:
+        await interaction.followup.send(f"👂 链接好像不对呀…鹅打不开这扇门\n错误信息：{str(e)}", ephemeral=True)
         return
 
-    # 确定文件类型
-    if 文件.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-        file_type = "image"
-    elif 文件.filename.lower().endswith('.json'):
-        file_type = "json"
-    else:
-        file_type = "other"
-
-    # 保存文件（名称过长时用帖子ID）
-    folder_name = post_name if len(post_name.encode('utf-8')) <= 100 else str(thread_id)
-    post_dir = os.path.join(FILES_DIR, folder_name)
-    os.makedirs(post_dir, exist_ok=True)
-    file_path = os.path.join(post_dir, f"{文件名}_{新版本}{os.path.splitext(文件.filename)[1]}")
-    file_bytes = await 文件.read()
-    with open(file_path, 'wb') as f:
-        f.write(file_bytes)
-
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    try:
-        c.execute(
-            "INSERT INTO files (post_name, file_name, version, file_path, file_type, uploaded_by, uploaded_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (post_name, 文件名, 新版本, file_path, file_type, interaction.user.id, datetime.now().isoformat())
-        )
-        conn.commit()
-        await interaction.followup.send(
-            f"👂 更新好了！\n"
-            f"📁 帖子：{post_name}\n"
-            f"📄 文件：{文件名}\n"
-            f"🏷️ 新版本：{新版本}",
-            ephemeral=True
-        )
-    except sqlite3.IntegrityError:
-        await interaction.followup.send(f"👂 版本 {新版本} 已经存在了，换个版本号吧！", ephemeral=True)
-    finally:
-        conn.close()
+    cursor = await db.execute(
+        "UPDATE OR IGNORE files SET thread_id = ? WHERE thread_id IS NULL AND post_name = ?",
+        (thread_id, 旧帖子名)
+    )
+    thread_catalog.invalidate(thread_id)
+    participation_threads.add(thread_id)
+    left = await db.fetchall("SELECT DISTINCT post_name FROM files WHERE thread_id IS NULL LIMIT 20")
+    message = f"👂 认领好了！{cursor.rowcount} 个文件归到了「{thread.name}」下面"
+    if left:
+        message += "\n\n还没认领的旧帖子名：\n" + "\n".join(f"　{name}" for (name,) in left)
+    await interaction.followup.send(message, ephemeral=True)
 
 # ============ 管理员：删除附件 ============
 @bot.tree.command(name="删除附件", description="【管理员】删除指定帖子下的某个文件版本")
@@ -844,74 +3124,247 @@ async def delete_file(interaction: discord.Interaction, 帖子链接: str):
         await interaction.followup.send(f"👂 链接好像不对呀…鹅打不开这扇门\n错误信息：{str(e)}", ephemeral=True)
         return
 
-    # 查询该帖子下的所有文件
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "SELECT id, file_name, version FROM files WHERE post_name = ? ORDER BY file_name, uploaded_at DESC",
-        (post_name,)
-    )
-    files = c.fetchall()
-    conn.close()
+    # 该帖子下的所有文件
+    catalog = await thread_catalog.get(thread_id, post_name)
+    files = [(fid, fname, ver) for fname, versions in sorted(catalog.items()) for ver, fid, _, _ in versions]
 
     if not files:
         await interaction.followup.send(f"👂 帖子「{post_name}」下面还没有文件呢～", ephemeral=True)
         return
 
     # 创建文件选择菜单
-    class DeleteSelectView(discord.ui.View):
-        def __init__(self):
-            super().__init__(timeout=60)
-            options = [
-                discord.SelectOption(
-                    label=f"{fname} ({ver})",
-                    value=str(fid)
-                ) for fid, fname, ver in files
-            ]
-            self.select = discord.ui.Select(placeholder="要删掉哪个呀？选一个吧...", options=options)
-            self.select.callback = self.file_selected
-            self.add_item(self.select)
-
-        async def file_selected(self, select_interaction: discord.Interaction):
-            selected_id = int(self.select.values[0])
-            await select_interaction.response.defer(ephemeral=True)
-
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("SELECT file_name, version, file_path FROM files WHERE id = ?", (selected_id,))
-            result = c.fetchone()
+    async def file_selected(select_interaction: discord.Interaction, values):
+        selected_id = int(values[0])
+        await select_interaction.response.defer(ephemeral=True)
 
-            if not result:
-                conn.close()
-                await select_interaction.followup.send("👂 文件不见了…鹅找不到呀", ephemeral=True)
-                return
+        result = await db.fetchone("SELECT file_name, version, file_path FROM files WHERE id = ?", (selected_id,))
 
-            fname, ver, fpath = result
+        if not result:
+            await select_interaction.followup.send("👂 文件不见了…鹅找不到呀", ephemeral=True)
+            return
 
-            # 删除实际文件
-            try:
-                if os.path.exists(fpath):
-                    os.remove(fpath)
-            except Exception:
-                pass
+        fname, ver, fpath = result
 
-            # 删除数据库记录
-            c.execute("DELETE FROM files WHERE id = ?", (selected_id,))
-            conn.commit()
-            conn.close()
+        # 删除数据库记录；别的版本没再用到这个文件的话，连同水印缓存一起删掉
+        if await db.run(delete_file_row, selected_id, fpath):
+            asset_cache.invalidate(fpath)
+        thread_catalog.invalidate(thread_id)
+        await release_tracking_codes(prerender_pool.drop(selected_id))
+        rendered_cache.drop_file(selected_id)
 
-            await select_interaction.followup.send(
-                f"👂 扔掉了！\n"
-                f"📄 {fname} ({ver})",
-                ephemeral=True
-            )
+        await select_interaction.followup.send(
+            f"👂 扔掉了！\n"
+            f"📄 {fname} ({ver})",
+            ephemeral=True
+        )
 
+    options = [discord.SelectOption(label=f"{fname} ({ver})", value=str(fid)) for fid, fname, ver in files]
+    view = PagedSelectView(paged_options(options), file_selected, "要删掉哪个呀？选一个吧...")
+    await view.load()
     await interaction.followup.send(
         f"👂 帖子「{post_name}」下的文件，要扔哪个？",
-        view=DeleteSelectView(),
+        view=view,
         ephemeral=True
     )
     
+# ============ 首楼点赞索引 ============
+# 论坛帖子的首楼消息 ID 和帖子 ID 相同，只记这一条消息上的点赞。
+# 平时靠点赞事件维护；机器人下线或断线期间的点赞收不到事件，所以每次连上 Discord 后，
+# 每个帖子都从 Discord 把首楼现有的点赞再同步一遍（后台挨个同步，有人来拿附件时先同步那个帖子），
+# 之后 /获取附件 检查资格只要查一次索引，不用再翻 reaction.users()。
+
+# 这次连上 Discord 以后已经同步过首楼点赞的帖子 ID（on_ready 时清空）
+reaction_backfilled = set()
+# 正在补的帖子 {thread_id: Task}，同一个帖子同时有人来拿附件时只补一次
+reaction_backfill_tasks: dict[int, asyncio.Task] = {}
+
+@bot.event
+async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
+    if payload.message_id != payload.channel_id:
+        return
+    db.enqueue(
+        "INSERT OR IGNORE INTO thread_reactions (thread_id, user_id, emoji) VALUES (?, ?, ?)",
+        (payload.channel_id, payload.user_id, str(payload.emoji))
+    )
+
+@bot.event
+async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
+    if payload.message_id != payload.channel_id:
+        return
+    db.enqueue(
+        "DELETE FROM thread_reactions WHERE thread_id = ? AND user_id = ? AND emoji = ?",
+        (payload.channel_id, payload.user_id, str(payload.emoji))
+    )
+
+@bot.event
+async def on_raw_reaction_clear(payload: discord.RawReactionClearEvent):
+    if payload.message_id != payload.channel_id:
+        return
+    db.enqueue("DELETE FROM thread_reactions WHERE thread_id = ?", (payload.channel_id,))
+
+@bot.event
+async def on_raw_reaction_clear_emoji(payload: discord.RawReactionClearEmojiEvent):
+    if payload.message_id != payload.channel_id:
+        return
+    db.enqueue("DELETE FROM thread_reactions WHERE thread_id = ? AND emoji = ?", (payload.channel_id, str(payload.emoji)))
+
+def save_reaction_backfill(conn, thread_id: int, rows):
+    conn.executemany("INSERT OR IGNORE INTO thread_reactions (thread_id, user_id, emoji) VALUES (?, ?, ?)", rows)
+    conn.execute(
+        "INSERT OR REPLACE INTO reaction_backfills (thread_id, completed_at) VALUES (?, ?)",
+        (thread_id, datetime.now().isoformat())
+    )
+
+async def backfill_thread_reactions(thread: discord.Thread):
+    """把帖子首楼现有的点赞全部记进索引（每次连上 Discord 后每个帖子做一次）
+
+    补的过程中收到的点赞事件照常写入；下线期间有人取消点赞的话索引里还留着，
+    最多让他多拿一次附件，可以接受。
+    """
+    starter_message = await thread.fetch_message(thread.id)
+    rows = []
+    for reaction in starter_message.reactions:
+        async for reaction_user in reaction.users():
+            rows.append((thread.id, reaction_user.id, str(reaction.emoji)))
+    await db.run(save_reaction_backfill, thread.id, rows)
+    reaction_backfilled.add(thread.id)
+
+def ensure_reaction_backfill(thread: discord.Thread) -> asyncio.Task:
+    task = reaction_backfill_tasks.get(thread.id)
+    if task is None:
+        task = asyncio.create_task(backfill_thread_reactions(thread))
+        reaction_backfill_tasks[thread.id] = task
+        task.add_done_callback(lambda _: reaction_backfill_tasks.pop(thread.id, None))
+    return task
+
+async def has_reacted_to_starter(thread: discord.Thread, user_id: int) -> bool:
+    """用户是否给帖子首楼点过赞（这次连接后还没同步过的帖子先同步再查）"""
+    if thread.id not in reaction_backfilled:
+        await asyncio.shield(ensure_reaction_backfill(thread))
+    row = await db.fetchone(
+        "SELECT 1 FROM thread_reactions WHERE thread_id = ? AND user_id = ? LIMIT 1",
+        (thread.id, user_id)
+    )
+    return row is not None
+
+# ============ 帖子参与索引 ============
+# 谁在帖子里评论过：新消息和删除靠事件维护，已有的历史消息由后台按页补录（断了能接着补），
+# /获取附件 检查资格只查一次索引，帖子多长都不会漏。
+# 机器人下线或断线期间的消息收不到事件，所以每次连上 Discord 后，每个帖子都从上次补到的位置再往后补一遍。
+# 只记有附件的帖子。
+
+# 有附件的帖子 ID，只有这些帖子的消息和删除才写进索引
+participation_threads = set()
+if not IN_WORKER_PROCESS:
+    participation_threads.update(row[0] for row in db.run_sync(
+        lambda conn: conn.execute("SELECT DISTINCT thread_id FROM files WHERE thread_id IS NOT NULL").fetchall()
+    ))
+# 这次连上 Discord 以后已经补到最新的帖子 ID（on_ready 时清空）
+participation_backfilled = set()
+# 正在补的帖子 {thread_id: Task}，后台和 /获取附件 同时要补同一个帖子时只补一次
+participation_crawl_tasks: dict[int, asyncio.Task] = {}
+
+def record_thread_message(message: discord.Message):
+    """把帖子里的一条评论记进索引（首楼和机器人的消息不算）"""
+    if message.channel.id not in participation_threads or message.author.bot or message.id == message.channel.id:
+        return
+    db.enqueue(
+        "INSERT OR IGNORE INTO thread_messages (message_id, thread_id, user_id) VALUES (?, ?, ?)",
+        (message.id, message.channel.id, message.author.id)
+    )
+
+@bot.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    if payload.channel_id not in participation_threads:
+        return
+    db.enqueue("DELETE FROM thread_messages WHERE message_id = ?", (payload.message_id,))
+
+@bot.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    if payload.channel_id not in participation_threads:
+        return
+    for message_id in payload.message_ids:
+        db.enqueue("DELETE FROM thread_messages WHERE message_id = ?", (message_id,))
+
+def save_participation_page(conn, thread_id: int, rows, last_message_id: int | None, completed: bool):
+    conn.executemany("INSERT OR IGNORE INTO thread_messages (message_id, thread_id, user_id) VALUES (?, ?, ?)", rows)
+    conn.execute(
+        "INSERT OR REPLACE INTO participation_backfills (thread_id, last_message_id, completed_at) VALUES (?, ?, ?)",
+        (thread_id, last_message_id, datetime.now().isoformat() if completed else None)
+    )
+
+async def crawl_thread_messages(thread: discord.Thread, pause: float):
+    """从上次补到的位置往后翻帖子的历史消息，每页存一次进度
+
+    补录期间的新消息和删除照常由事件写入；已经删掉的消息翻不到，所以补完的结果和事件维护的一致。
+    补完过的帖子再调用时只翻上次之后的新消息（补上下线期间漏掉的）。
+    """
+    participation_threads.add(thread.id)
+    row = await db.fetchone("SELECT last_message_id FROM participation_backfills WHERE thread_id = ?", (thread.id,))
+    last_message_id = row[0] if row else None
+    after = discord.Object(id=last_message_id) if last_message_id else None
+    rows = []
+    total = 0
+    async for message in thread.history(limit=None, after=after, oldest_first=True):
+        last_message_id = message.id
+        if not message.author.bot and message.id != thread.id:
+            rows.append((message.id, thread.id, message.author.id))
+        total += 1
+        # history 每次请求取 100 条，翻完一页存一次进度再歇一会儿，不和别的请求抢速率限制
+        if total % 100 == 0:
+            await db.run(save_participation_page, thread.id, rows, last_message_id, False)
+            rows = []
+            if pause:
+                await asyncio.sleep(pause)
+    await db.run(save_participation_page, thread.id, rows, last_message_id, True)
+    participation_backfilled.add(thread.id)
+    if total:
+        print(f"[参与索引] 帖子「{thread.name}」补录完成，本次翻了 {total} 条消息")
+
+def ensure_participation_backfill(thread: discord.Thread, pause: float) -> asyncio.Task:
+    task = participation_crawl_tasks.get(thread.id)
+    if task is None:
+        task = asyncio.create_task(crawl_thread_messages(thread, pause))
+        participation_crawl_tasks[thread.id] = task
+        task.add_done_callback(lambda _: participation_crawl_tasks.pop(thread.id, None))
+    return task
+
+async def has_commented_in(thread: discord.Thread, user_id: int) -> bool:
+    """用户是否在帖子里评论过（这次连接后还没补到最新时先补完再查，用户等的时候不歇）"""
+    query = "SELECT 1 FROM thread_messages WHERE thread_id = ? AND user_id = ? LIMIT 1"
+    if await db.fetchone(query, (thread.id, user_id)):
+        return True
+    if thread.id in participation_backfilled:
+        return False
+    await asyncio.shield(ensure_participation_backfill(thread, 0))
+    return await db.fetchone(query, (thread.id, user_id)) is not None
+
+@tasks.loop(minutes=PARTICIPATION_CRAWL_MINUTES)
+async def crawl_thread_participation():
+    """后台一个一个补录有附件的帖子（评论和首楼点赞）"""
+    thread_ids = await db.fetchall("SELECT DISTINCT thread_id FROM files WHERE thread_id IS NOT NULL")
+    participation_threads.update(thread_id for (thread_id,) in thread_ids)
+    for (thread_id,) in thread_ids:
+        if thread_id in participation_backfilled and thread_id in reaction_backfilled:
+            continue
+        try:
+            thread = bot.get_channel(thread_id) or await bot.fetch_channel(thread_id)
+            if thread_id not in participation_backfilled:
+                await asyncio.shield(ensure_participation_backfill(thread, PARTICIPATION_CRAWL_PAUSE))
+            if thread_id not in reaction_backfilled:
+                await asyncio.shield(ensure_reaction_backfill(thread))
+                await asyncio.sleep(PARTICIPATION_CRAWL_PAUSE)
+        except (discord.NotFound, discord.Forbidden):
+            # 帖子没了或者看不到：这次连接期间不再反复尝试，补录进度留着
+            participation_backfilled.add(thread_id)
+            reaction_backfilled.add(thread_id)
+        except Exception as e:
+            print(f"[参与索引] 补录帖子 {thread_id} 失败：{e}")
+
+@crawl_thread_participation.before_loop
+async def before_crawl_thread_participation():
+    await bot.wait_until_ready()
+
 # ============ 用户：获取附件 ============
 @bot.tree.command(name="获取附件", description="获取当前帖子的附件文件（需先点赞首楼或评论）")
 async def get_file(interaction: discord.Interaction):
@@ -936,29 +3389,18 @@ async def get_file(interaction: discord.Interaction):
     has_reacted = False
     has_commented = False
 
-    # 检查首楼点赞
+    # 检查是否发过评论（查参与索引）
     try:
-        starter_message = channel.starter_message
-        if starter_message is None:
-            starter_message = await channel.fetch_message(channel.id)
-
-        if starter_message:
-            for reaction in starter_message.reactions:
-                async for reaction_user in reaction.users():
-                    if reaction_user.id == user.id:
-                        has_reacted = True
-                        break
-                if has_reacted:
-                    break
-    except Exception:
-        pass
+        has_commented = await has_commented_in(channel, user.id)
+    except Exception as e:
+        print(f"[参与索引] 帖子「{post_name}」补录消息失败：{e}")
 
-    # 检查是否发过评论
-    if not has_reacted:
-        async for message in channel.history(limit=200):
-            if message.author.id == user.id and message.id != channel.id:
-                has_commented = True
-                break
+    # 检查首楼点赞（查点赞索引）
+    if not has_commented:
+        try:
+            has_reacted = await has_reacted_to_starter(channel, user.id)
+        except Exception as e:
+            print(f"[点赞索引] 帖子「{post_name}」补录点赞失败：{e}")
 
     if not has_reacted and not has_commented:
         embed = discord.Embed(
@@ -970,11 +3412,8 @@ async def get_file(interaction: discord.Interaction):
         return
 
     # ---- 查询该帖子下的可用文件 ----
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT file_name FROM files WHERE post_name = ?", (post_name,))
-    file_names = [row[0] for row in c.fetchall()]
-    conn.close()
+    catalog = await thread_catalog.get(channel.id, post_name)
+    file_names = list(catalog)
 
     if not file_names:
         embed = discord.Embed(
@@ -985,129 +3424,177 @@ async def get_file(interaction: discord.Interaction):
         await interaction.followup.send(embed=embed, ephemeral=True)
         return
 
-    # 创建文件选择菜单
-    class FileSelectView(discord.ui.View):
-        def __init__(self):
-            super().__init__(timeout=60)
-            options = [discord.SelectOption(label=name, value=name) for name in file_names]
-            self.select = discord.ui.Select(placeholder="👂 想要啥？选一个吧...", options=options)
-            self.select.callback = self.file_selected
-            self.add_item(self.select)
-
-        async def file_selected(self, select_interaction: discord.Interaction):
-            selected_file = self.select.values[0]
-
-            # 查询该文件的所有版本
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute(
-                "SELECT version FROM files WHERE post_name = ? AND file_name = ? ORDER BY uploaded_at DESC",
-                (post_name, selected_file)
-            )
-            versions = [row[0] for row in c.fetchall()]
-            conn.close()
-
-            # 创建版本选择菜单
-            class VersionSelectView(discord.ui.View):
-                def __init__(self):
-                    super().__init__(timeout=60)
-                    options = [discord.SelectOption(label=v, value=v) for v in versions]
-                    self.select = discord.ui.Select(placeholder="👂 要哪个版本？", options=options)
-                    self.select.callback = self.version_selected
-                    self.add_item(self.select)
-
-                async def version_selected(self, version_interaction: discord.Interaction):
-                    selected_version = self.select.values[0]
-                    await version_interaction.response.defer(ephemeral=True)
-
-                    # 获取文件信息
-                    conn = sqlite3.connect(DB_PATH)
-                    c = conn.cursor()
-                    c.execute(
-                        "SELECT id, file_path, file_type FROM files WHERE post_name = ? AND file_name = ? AND version = ?",
-                        (post_name, selected_file, selected_version)
-                    )
-                    result = c.fetchone()
-                    conn.close()
+    # 创建文件选择菜单（文件和版本多的时候分页）
+    async def file_selected(select_interaction: discord.Interaction, values):
+        selected_file = values[0]
 
-                    if not result:
-                        await version_interaction.followup.send("👂 文件不见了…鹅找不到呀", ephemeral=True)
-                        return
+        # 该文件的所有版本
+        catalog = await thread_catalog.get(channel.id, post_name)
+        versions = [ver for ver, _, _, _ in catalog.get(selected_file, [])]
+
+        # 创建版本选择菜单
+        async def version_selected(version_interaction: discord.Interaction, values):
+            selected_version = values[0]
+            await version_interaction.response.defer(ephemeral=True)
+
+            # 获取文件信息
+            catalog = await thread_catalog.get(channel.id, post_name)
+            result = next((entry[1:] for entry in catalog.get(selected_file, []) if entry[0] == selected_version), None)
 
-                    file_id, file_path, file_type = result
+            if not result:
+                await version_interaction.followup.send("👂 文件不见了…鹅找不到呀", ephemeral=True)
+                return
 
-                    # 读取原始文件
-                    with open(file_path, 'rb') as f:
-                        file_bytes = f.read()
+            file_id, file_path, file_type = result
 
+            # 同一个人同一个文件同时只处理一次
+            delivery_key = (user.id, file_id)
+            if delivery_key in deliveries_in_flight:
+                await version_interaction.followup.send("👂 这个文件正在给你做呢～稍等一下下", ephemeral=True)
+                return
+            deliveries_in_flight.add(delivery_key)
+            try:
+                await deliver_file(version_interaction, file_id, file_path, file_type, selected_file, selected_version)
+            finally:
+                deliveries_in_flight.discard(delivery_key)
+
+        async def deliver_file(version_interaction, file_id, file_path, file_type, selected_file, selected_version):
+            # 要排队的话先发一条排队消息，之后位置变化、出结果都改这一条
+            queue_message = None
+
+            async def show_queue_position(position: int):
+                nonlocal queue_message
+                text = f"👂 排队中…你是第 **{position}** 个，做好了鹅会直接把文件放在这里～"
+                if queue_message is None:
+                    queue_message = await version_interaction.followup.send(text, ephemeral=True, wait=True)
+                else:
+                    await queue_message.edit(content=text)
+
+            async def reply(text: str):
+                if queue_message is None:
+                    await version_interaction.followup.send(text, ephemeral=True)
+                else:
+                    await queue_message.edit(content=text)
+
+            # 拿过这个文件的话沿用第一次的追踪码，做过的水印文件直接从缓存发
+            previous = await db.fetchone(
+                "SELECT tracking_code FROM tracking WHERE user_id = ? AND file_id = ? ORDER BY retrieved_at LIMIT 1",
+                (user.id, file_id)
+            )
+            tracking_code = previous[0] if previous else None
+            watermarked = file_type in ("image", "json")
+            cached = rendered_cache.get(file_id, tracking_code) if previous and watermarked else None
+
+            # 热门文件直接领一份预渲染好的副本，没有再现场生成；其他类型的文件不打水印，直接从仓库发
+            copy = None
+            out_path = None
+            if cached:
+                out_path, ext = cached
+            elif not watermarked:
+                tracking_code = tracking_code or await generate_tracking_code()
+                ext = os.path.splitext(file_path)[1]
+            else:
+                if tracking_code is None:
+                    prerender_pool.note_request(file_id, file_path, file_type)
+                    copy = prerender_pool.claim(file_id)
+                if copy:
+                    tracking_code, out_path, ext = copy
+                else:
                     # 生成追踪码
-                    tracking_code = generate_tracking_code()
+                    tracking_code = tracking_code or await generate_tracking_code()
 
-                    # 嵌入水印
+                    # 读取原始文件（热门文件走缓存），排队轮到了再嵌入水印，结果写进待发送的临时文件
                     try:
-                        if file_type == "image":
-                            watermarked_bytes = embed_image_watermark(file_bytes, tracking_code)
-                            original_ext = os.path.splitext(file_path)[1].lower()
-                            ext = original_ext if original_ext in ('.png', '.jpg', '.jpeg') else '.png'
-                        elif file_type == "json":
-                            watermarked_bytes = embed_json_watermark(file_bytes, tracking_code)
-                            ext = ".json"
-                        else:
-                            watermarked_bytes = file_bytes
-                            ext = os.path.splitext(file_path)[1]
+                        asset = await watermark.load(file_path, file_type)
+                        out_path, ext = await render_scheduler.run(
+                            user.id, asset[3],
+                            lambda: watermark.embed(asset, file_type, file_path, tracking_code),
+                            show_queue_position
+                        )
+                    except RenderLimited:
+                        await reply("👂 你手上还有文件在做呢～等它们好了再来拿下一个吧")
+                        return
+                    except WatermarkBusy:
+                        await reply("👂 鹅现在忙不过来啦～过一会儿再来拿吧")
+                        return
+                    except WatermarkTooLarge:
+                        await reply("👂 这个文件太大了，鹅一口吃不下…找管理员帮帮忙吧")
+                        return
+                    except asyncio.TimeoutError:
+                        await reply("👂 文件太大了，鹅处理超时了…过一会儿再试试吧")
+                        return
                     except Exception as e:
-                        await version_interaction.followup.send(f"👂 水印没打上去：{str(e)}", ephemeral=True)
+                        await reply(f"👂 水印没打上去：{str(e)}")
                         return
 
-                    # 记录追踪信息
-                    conn = sqlite3.connect(DB_PATH)
-                    c = conn.cursor()
-                    c.execute(
-                        "INSERT INTO tracking (tracking_code, user_id, user_name, file_id, post_name, file_name, version, retrieved_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                        (tracking_code, user.id, user.name, file_id, post_name, selected_file, selected_version, datetime.now().isoformat())
-                    )
-                    conn.commit()
-                    conn.close()
-
-                    # 发送水印文件
-                    file_obj = discord.File(
-                        io.BytesIO(watermarked_bytes),
-                        filename=f"{selected_file}_{selected_version}{ext}"
-                    )
-                    embed = discord.Embed(
-                        title="👂 给你给你～拿好哦！",
-                        description=(
-                            f"📄 **{selected_file}** ({selected_version})\n\n"
-                            "🔒 鹅已经在上面做了小小的记号～\n"
-                            "要好好保管，不要到处传哦🐾"
-                        ),
-                        color=0x00ff88
-                    )
+            # 第一次拿才记录追踪信息（领到的副本顺便把预留的追踪码转正）
+            # 追踪记录是查泄露的唯一依据：提交成功了才发文件，没记上就不发
+            if previous is None:
+                try:
+                    await db.run(record_tracking, (tracking_code, user.id, user.name, file_id, post_name, selected_file, selected_version, datetime.now().isoformat()))
+                except sqlite3.Error as e:
+                    print(f"[追踪] 记录追踪码 {tracking_code} 失败：{e}")
+                    discard_delivery(out_path)
+                    await reply("👂 鹅的小本本没记上…这次先不发啦，过一会儿再试试吧")
+                    return
+
+            # 发送水印文件（直接从磁盘读着发，新做的发完留进缓存）
+            file_obj = discord.File(
+                out_path or file_path,
+                filename=f"{selected_file}_{selected_version}{ext}"
+            )
+            embed = discord.Embed(
+                title="👂 给你给你～拿好哦！",
+                description=(
+                    f"📄 **{selected_file}** ({selected_version})\n\n"
+                    "🔒 鹅已经在上面做了小小的记号～\n"
+                    "要好好保管，不要到处传哦🐾"
+                ),
+                color=0x00ff88
+            )
+            try:
+                if queue_message is None:
                     await version_interaction.followup.send(
                         embed=embed,
                         file=file_obj,
                         ephemeral=True
                     )
+                else:
+                    await queue_message.edit(content=None, embed=embed, attachments=[file_obj])
+            finally:
+                file_obj.close()
+                if out_path and not cached:
+                    rendered_cache.put(file_id, tracking_code, out_path, ext)
 
-            embed = discord.Embed(
-                title=f"📄 {selected_file}",
-                description="请选择你需要的版本：",
-                color=0x7b68ee
-            )
-            await select_interaction.response.send_message(
-                embed=embed,
-                view=VersionSelectView(),
-                ephemeral=True
-            )
+        embed = discord.Embed(
+            title=f"📄 {selected_file}",
+            description="请选择你需要的版本：",
+            color=0x7b68ee
+        )
+        view = PagedSelectView(
+            paged_options([discord.SelectOption(label=v, value=v) for v in versions]),
+            version_selected, "👂 要哪个版本？"
+        )
+        await view.load()
+        await select_interaction.response.send_message(
+            embed=embed,
+            view=view,
+            ephemeral=True
+        )
 
     embed = discord.Embed(
         title="👂 欢迎来到鹅的小仓库！",
         description="想要什么文件呀？选一个吧～",
         color=0x7b68ee
     )
+    view = PagedSelectView(
+        paged_options([discord.SelectOption(label=name, value=name) for name in file_names]),
+        file_selected, "👂 想要啥？选一个吧..."
+    )
+    await view.load()
     await interaction.followup.send(
         embed=embed,
-        view=FileSelectView(),
+        view=view,
         ephemeral=True
     )
 
@@ -1124,25 +3611,24 @@ async def verify_watermark(interaction: discord.Interaction, 文件: discord.Att
     file_bytes = await 文件.read()
 
     # 根据文件类型提取水印
-    tracking_code = None
-    if 文件.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-        tracking_code = extract_image_watermark(file_bytes)
-    elif 文件.filename.lower().endswith('.json'):
-        tracking_code = extract_json_watermark(file_bytes)
+    try:
+        tracking_code = await watermark.extract(文件.filename, file_bytes)
+    except WatermarkBusy:
+        await interaction.followup.send("👂 鹅现在忙不过来啦～过一会儿再来验证吧", ephemeral=True)
+        return
+    except asyncio.TimeoutError:
+        await interaction.followup.send("👂 文件太大了，鹅处理超时了…", ephemeral=True)
+        return
 
     if not tracking_code:
         await interaction.followup.send("👂 鹅闻了闻…没有闻到水印的味道呢，可能不是从这里发出去的，或者水印被弄坏了", ephemeral=True)
         return
 
     # 查询追踪记录
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
+    result = await db.fetchone(
         "SELECT user_id, user_name, post_name, file_name, version, retrieved_at FROM tracking WHERE tracking_code = ?",
         (tracking_code,)
     )
-    result = c.fetchone()
-    conn.close()
 
     if result:
         user_id, user_name, post_name, file_name, version, retrieved_at = result
@@ -1161,6 +3647,137 @@ async def verify_watermark(interaction: discord.Interaction, 文件: discord.Att
             ephemeral=True
         )
         
+# ============ 管理员：批量验证水印 ============
+WATERMARK_EXTS = ('.png', '.jpg', '.jpeg', '.json')
+
+def list_zip_members(zip_bytes):
+    """列出压缩包里可以验证的文件（跳过目录、系统垃圾文件和超大文件）"""
+    zf = zipfile.ZipFile(io.BytesIO(zip_bytes))
+    members = []
+    skipped = []
+    for info in zf.infolist():
+        name = info.filename
+        if info.is_dir() or name.startswith("__MACOSX/") or os.path.basename(name).startswith("."):
+            continue
+        if not name.lower().endswith(WATERMARK_EXTS):
+            skipped.append((name, "不支持的文件类型"))
+        elif info.file_size > BATCH_VERIFY_MAX_MB * 1024 * 1024:
+            skipped.append((name, "文件太大"))
+        elif len(members) >= BATCH_VERIFY_MAX_FILES:
+            skipped.append((name, f"超过 {BATCH_VERIFY_MAX_FILES} 个文件上限"))
+        else:
+            members.append(name)
+    return zf, members, skipped
+
+@bot.tree.command(name="批量验证水印", description="【管理员】上传压缩包或多个文件，一次查出所有泄露者")
+@app_commands.describe(
+    文件="压缩包（.zip）或要验证的文件",
+    文件2="更多文件（可选）", 文件3="更多文件（可选）", 文件4="更多文件（可选）",
+    文件5="更多文件（可选）", 文件6="更多文件（可选）", 文件7="更多文件（可选）",
+    文件8="更多文件（可选）", 文件9="更多文件（可选）", 文件10="更多文件（可选）"
+)
+async def batch_verify_watermark(
+    interaction: discord.Interaction,
+    文件: discord.Attachment,
+    文件2: discord.Attachment = None, 文件3: discord.Attachment = None, 文件4: discord.Attachment = None,
+    文件5: discord.Attachment = None, 文件6: discord.Attachment = None, 文件7: discord.Attachment = None,
+    文件8: discord.Attachment = None, 文件9: discord.Attachment = None, 文件10: discord.Attachment = None
+):
+    if not is_admin(interaction):
+        await interaction.response.send_message("👂 这个只有管理员才能用哦～鹅也没办法呀", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+
+    attachments = [a for a in (文件, 文件2, 文件3, 文件4, 文件5, 文件6, 文件7, 文件8, 文件9, 文件10) if a]
+    # 每一项：(显示名, 读取内容的异步函数)；压缩包里的文件用到时才在内存里解压，不落盘
+    jobs = []
+    skipped = []
+    for attachment in attachments:
+        if attachment.filename.lower().endswith('.zip'):
+            try:
+                zf, members, zip_skipped = list_zip_members(await attachment.read())
+            except zipfile.BadZipFile:
+                skipped.append((attachment.filename, "压缩包打不开"))
+                continue
+            for name in members:
+                jobs.append((f"{attachment.filename}/{name}", lambda zf=zf, name=name: asyncio.to_thread(zf.read, name)))
+            skipped.extend((f"{attachment.filename}/{name}", reason) for name, reason in zip_skipped)
+        elif attachment.filename.lower().endswith(WATERMARK_EXTS):
+            jobs.append((attachment.filename, attachment.read))
+        else:
+            skipped.append((attachment.filename, "不支持的文件类型"))
+
+    # 并行提取追踪码，同时在跑的任务数不超过水印工作进程数
+    slots = asyncio.Semaphore(watermark.workers)
+
+    async def extract_one(name, reader):
+        async with slots:
+            try:
+                data = await reader()
+                return name, await watermark.extract(name, data), None
+            except WatermarkBusy:
+                return name, None, "鹅太忙了，没处理到"
+            except asyncio.TimeoutError:
+                return name, None, "处理超时"
+            except Exception as e:
+                return name, None, f"读取失败：{e}"
+
+    results = await asyncio.gather(*(extract_one(name, reader) for name, reader in jobs))
+
+    # 一次查出所有追踪码
+    codes = sorted({code for _, code, _ in results if code})
+    records = {}
+    if codes:
+        rows = await db.fetchall(
+            f"SELECT tracking_code, user_id, user_name, post_name, file_name, version, retrieved_at FROM tracking WHERE tracking_code IN ({','.join('?' * len(codes))})",
+            codes
+        )
+        records = {row[0]: row[1:] for row in rows}
+
+    # 按泄露者分组
+    by_user = {}
+    unknown = []
+    no_mark = []
+    for name, code, error in results:
+        if error:
+            skipped.append((name, error))
+        elif not code:
+            no_mark.append(name)
+        elif code not in records:
+            unknown.append((name, code))
+        else:
+            by_user.setdefault(records[code][0], []).append((name, code, records[code]))
+
+    lines = [f"👂 **批量验证结果：** 共 {len(results)} 个文件，查到 {len(by_user)} 位泄露者\n"]
+    for user_id, items in sorted(by_user.items(), key=lambda kv: -len(kv[1])):
+        lines.append(f"👤 **{items[0][2][1]}**（ID: {user_id}）— {len(items)} 个文件")
+        for name, code, (_, _, post_name, file_name, version, retrieved_at) in items:
+            lines.append(f"　`{code}` {name} → {post_name} / {file_name} ({version}) | {retrieved_at}")
+    if unknown:
+        lines.append("\n🔑 **有追踪码但没有记录：**")
+        lines.extend(f"　`{code}` {name}" for name, code in unknown)
+    if no_mark:
+        lines.append(f"\n🫥 **没有水印：** {len(no_mark)} 个")
+        lines.extend(f"　{name}" for name in no_mark)
+    if skipped:
+        lines.append(f"\n⏭️ **跳过：** {len(skipped)} 个")
+        lines.extend(f"　{name}（{reason}）" for name, reason in skipped)
+    report = "\n".join(lines)
+
+    if len(report) <= 1900:
+        await interaction.followup.send(report, ephemeral=True)
+    else:
+        summary = lines[0] + "\n".join(
+            f"👤 {items[0][2][1]}（ID: {user_id}）— {len(items)} 个文件"
+            for user_id, items in sorted(by_user.items(), key=lambda kv: -len(kv[1]))[:20]
+        )
+        await interaction.followup.send(
+            summary[:1900] + "\n\n📎 完整报告在附件里哦",
+            file=discord.File(io.BytesIO(report.encode('utf-8')), filename="watermark_report.txt"),
+            ephemeral=True
+        )
+
 # ============ 管理员：查看追踪记录 ============
 @bot.tree.command(name="查看记录", description="【管理员】查看某个帖子的所有文件获取记录")
 @app_commands.describe(帖子名称="要查看的帖子名称")
@@ -1169,14 +3786,10 @@ async def view_tracking(interaction: discord.Interaction, 帖子名称: str):
         await interaction.response.send_message("👂 这个只有管理员才能用哦～鹅也没办法呀", ephemeral=True)
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
+    records = await db.fetchall(
         "SELECT tracking_code, user_name, file_name, version, retrieved_at FROM tracking WHERE post_name = ? ORDER BY retrieved_at DESC LIMIT 20",
         (帖子名称,)
     )
-    records = c.fetchall()
-    conn.close()
 
     if not records:
         await interaction.response.send_message(f"👂 帖子「{帖子名称}」还没有人来拿过呢～", ephemeral=True)
@@ -1188,18 +3801,42 @@ async def view_tracking(interaction: discord.Interaction, 帖子名称: str):
 
     await interaction.response.send_message(text, ephemeral=True)
 
+# ============ 管理员：查看缓存状态 ============
+@bot.tree.command(name="缓存状态", description="【管理员】查看热门文件缓存的命中/淘汰情况")
+async def cache_status(interaction: discord.Interaction):
+    if not is_admin(interaction):
+        await interaction.response.send_message("👂 这个只有管理员才能用哦～鹅也没办法呀", ephemeral=True)
+        return
+
+    stats = asset_cache.stats()
+    rendered = rendered_cache.stats()
+    await interaction.response.send_message(
+        f"👂 **热门文件缓存：**\n\n"
+        f"📦 已缓存：{stats['entries']} 个文件，{stats['size'] / 1024 / 1024:.1f} / {stats['budget'] / 1024 / 1024:.0f} MB\n"
+        f"✅ 命中：{stats['hits']} 次\n"
+        f"❌ 未命中：{stats['misses']} 次\n"
+        f"🗑️ 淘汰：{stats['evictions']} 次\n"
+        f"📈 命中率：{stats['hit_rate']:.1%}\n\n"
+        f"👂 **重复领取缓存：**\n\n"
+        f"📦 已缓存：{rendered['entries']} 份，{rendered['size'] / 1024 / 1024:.1f} / {rendered['budget'] / 1024 / 1024:.0f} MB\n"
+        f"📈 命中率：{rendered['hit_rate']:.1%}（{rendered['hits']} / {rendered['hits'] + rendered['misses']}）",
+        ephemeral=True
+    )
+
 # ============ 匿名区功能 ============
 
-def get_or_assign_nickname(user_id: int, channel_id: int) -> str:
+async def get_or_assign_nickname(user_id: int, channel_id: int) -> str:
     """获取用户在某频道的当前轮次匿名昵称，如果没有则分配一个新的"""
-    conn = sqlite3.connect(DB_PATH)
+    return await db.run(assign_nickname, user_id, channel_id)
+
+def assign_nickname(conn, user_id: int, channel_id: int) -> str:
+    """在数据库线程上查询或分配昵称（查和写在同一个事务里）"""
     c = conn.cursor()
     
     # 先查是否已有昵称
     c.execute("SELECT nickname FROM anon_identities WHERE user_id = ? AND channel_id = ?", (user_id, channel_id))
     result = c.fetchone()
     if result:
-        conn.close()
         return result[0]
     
     # 查询该频道已使用的昵称
@@ -1219,36 +3856,31 @@ def get_or_assign_nickname(user_id: int, channel_id: int) -> str:
         "INSERT INTO anon_identities (user_id, channel_id, nickname, assigned_at) VALUES (?, ?, ?, ?)",
         (user_id, channel_id, nickname, datetime.now().isoformat())
     )
-    conn.commit()
-    conn.close()
     return nickname
 
+# 匿名频道登记表：{(guild_id, channel_id)}，启动时从数据库载入（见 load_anon_channels），
+# 设置/取消匿名频道时同步更新，这样普通频道的每条消息都不用查数据库
+anon_channel_registry = set()
+
+def load_anon_channels():
+    """启动时（连上 Discord 之前）把匿名频道载入登记表"""
+    anon_channel_registry.clear()
+    anon_channel_registry.update(db.run_sync(lambda conn: conn.execute("SELECT guild_id, channel_id FROM anon_channels").fetchall()))
+
 def is_anon_channel(guild_id: int, channel_id: int) -> bool:
     """检查频道是否为匿名频道"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM anon_channels WHERE guild_id = ? AND channel_id = ?", (guild_id, channel_id))
-    result = c.fetchone()
-    conn.close()
-    return result is not None
+    return (guild_id, channel_id) in anon_channel_registry
 
 # ---- 定时刷新匿名昵称 ----
 @tasks.loop(hours=ANON_REFRESH_HOURS)
 async def refresh_anon_nicknames():
     """定期清空所有匿名身份映射，下次发言时会重新分配新昵称"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    deleted = c.execute("DELETE FROM anon_identities").rowcount
-    conn.commit()
-    conn.close()
+    deleted = (await db.execute("DELETE FROM anon_identities")).rowcount
     print(f"[匿名刷新] 已清空 {deleted} 条匿名身份映射，所有昵称将在下次发言时重新分配")
     
     # 向所有匿名频道发送刷新通知
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT channel_id FROM anon_channels")
-    channel_ids = [row[0] for row in c.fetchall()]
-    conn.close()
+    rows = await db.fetchall("SELECT channel_id FROM anon_channels")
+    channel_ids = [row[0] for row in rows]
     
     for ch_id in channel_ids:
         try:
@@ -1281,14 +3913,12 @@ async def set_anon_channel(interaction: discord.Interaction):
     guild_id = interaction.guild_id
     channel_id = interaction.channel_id
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     try:
-        c.execute(
+        await db.execute(
             "INSERT OR REPLACE INTO anon_channels (guild_id, channel_id, set_by, set_at) VALUES (?, ?, ?, ?)",
             (guild_id, channel_id, interaction.user.id, datetime.now().isoformat())
         )
-        conn.commit()
+        anon_channel_registry.add((guild_id, channel_id))
         embed = discord.Embed(
             title="🎭 匿名区开张啦！",
             description=(
@@ -1305,8 +3935,6 @@ async def set_anon_channel(interaction: discord.Interaction):
         await interaction.response.send_message(embed=embed)
     except Exception as e:
         await interaction.response.send_message(f"❌ 设置失败：{str(e)}", ephemeral=True)
-    finally:
-        conn.close()
 
 # ---- 管理员：取消匿名频道 ----
 @bot.tree.command(name="取消匿名频道", description="【管理员】取消当前频道的匿名发言区设置")
@@ -1318,12 +3946,9 @@ async def unset_anon_channel(interaction: discord.Interaction):
     guild_id = interaction.guild_id
     channel_id = interaction.channel_id
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM anon_channels WHERE guild_id = ? AND channel_id = ?", (guild_id, channel_id))
-    deleted = c.rowcount
-    conn.commit()
-    conn.close()
+    cursor = await db.execute("DELETE FROM anon_channels WHERE guild_id = ? AND channel_id = ?", (guild_id, channel_id))
+    deleted = cursor.rowcount
+    anon_channel_registry.discard((guild_id, channel_id))
     
     if deleted:
         await interaction.response.send_message("👂 好的呀，匿名区关门啦～大家的秘密鹅会好好保管的", ephemeral=True)
@@ -1333,11 +3958,7 @@ async def unset_anon_channel(interaction: discord.Interaction):
 # ---- 全员：手动刷新匿名昵称 ----
 @bot.tree.command(name="刷新匿名昵称", description="【管理员】立即刷新所有匿名频道的昵称分配")
 async def manual_refresh_nicknames(interaction: discord.Interaction):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    deleted = c.execute("DELETE FROM anon_identities").rowcount
-    conn.commit()
-    conn.close()
+    deleted = (await db.execute("DELETE FROM anon_identities")).rowcount
     
     # 重置定时器，从现在开始重新计时
     refresh_anon_nicknames.restart()
@@ -1382,7 +4003,7 @@ async def anon_speak(
     await interaction.response.defer(ephemeral=True)
     
     # 获取/分配匿名昵称（当前轮次内保持一致）
-    nickname = get_or_assign_nickname(interaction.user.id, channel.id)
+    nickname = await get_or_assign_nickname(interaction.user.id, channel.id)
     
     # 获取昵称对应的 emoji 头像 URL
     avatar_url = get_nickname_avatar_url(nickname)
@@ -1429,14 +4050,10 @@ async def anon_speak(
         webhook_message = await webhook.send(**send_kwargs)
         
         # 记录到数据库（历史记录永久保留，不受刷新影响）
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(
+        db.enqueue(
             "INSERT INTO anon_messages (bot_message_id, channel_id, user_id, nickname, content, sent_at) VALUES (?, ?, ?, ?, ?, ?)",
             (webhook_message.id, channel.id, interaction.user.id, nickname, 内容 or "", datetime.now().isoformat())
         )
-        conn.commit()
-        conn.close()
         
         # 成功时静默回复，不打扰聊天
         await interaction.followup.send("✅", ephemeral=True)
@@ -1446,6 +4063,8 @@ async def anon_speak(
 # ---- 自动匿名转发：匿名频道中直接打字自动变匿名 ----
 @bot.event
 async def on_message(message):
+    record_thread_message(message)
+
     # 忽略 Bot 自己的消息和 Webhook 消息
     if message.author.bot:
         await bot.process_commands(message)
@@ -1473,7 +4092,7 @@ async def on_message(message):
     # 是匿名频道 → 自动转发
     try:
         # 获取/分配匿名昵称
-        nickname = get_or_assign_nickname(message.author.id, channel.id)
+        nickname = await get_or_assign_nickname(message.author.id, channel.id)
         avatar_url = get_nickname_avatar_url(nickname)
         
         # 处理附件
@@ -1519,14 +4138,10 @@ async def on_message(message):
         webhook_message = await webhook.send(**send_kwargs)
         
         # 记录到数据库
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(
+        db.enqueue(
             "INSERT INTO anon_messages (bot_message_id, channel_id, user_id, nickname, content, sent_at) VALUES (?, ?, ?, ?, ?, ?)",
             (webhook_message.id, channel.id, message.author.id, nickname, message.content or "", datetime.now().isoformat())
         )
-        conn.commit()
-        conn.close()
         
     except Exception as e:
         # 转发失败时尝试提示用户
@@ -1556,14 +4171,10 @@ async def check_anon_identity(interaction: discord.Interaction, 消息链接: st
         return
     
     # 查询数据库（从永久保留的消息记录中查）
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
+    result = await db.fetchone(
         "SELECT user_id, nickname, content, sent_at FROM anon_messages WHERE bot_message_id = ? AND channel_id = ?",
         (message_id, channel_id)
     )
-    result = c.fetchone()
-    conn.close()
     
     if not result:
         await interaction.response.send_message("👂 鹅翻了翻记录…这条好像不是匿名消息呢", ephemeral=True)
@@ -1749,14 +4360,10 @@ async def send_subscribe_panel(interaction: discord.Interaction):
         
         # 存入数据库，bot重启时恢复
         role_ids_json = json.dumps([r.id for r in chosen_roles])
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(
+        await db.execute(
             "INSERT INTO subscribe_panels (message_id, channel_id, guild_id, role_ids, created_at) VALUES (?, ?, ?, ?, ?)",
             (panel_msg.id, btn_interaction.channel_id, guild.id, role_ids_json, datetime.now().isoformat())
         )
-        conn.commit()
-        conn.close()
         
         await btn_interaction.response.send_message("👂 订阅面板发送成功啦！", ephemeral=True)
         admin_view.stop()
@@ -1805,13 +4412,9 @@ async def create_lottery(interaction: discord.Interaction, 标题: str, 奖品:
             await interaction.followup.send("👂 时长格式不对呀～例子：`30m`（30分钟）、`2h`（2小时）、`1d`（1天）、`1d2h30m`（1天2小时30分钟）", ephemeral=True)
             return
         end_time = datetime.now() + duration_delta
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT INTO lotteries (guild_id, channel_id, title, prize, winner_count, required_role_id, created_by, created_at, end_time, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'active')",
+    cursor = await db.execute("INSERT INTO lotteries (guild_id, channel_id, title, prize, winner_count, required_role_id, created_by, created_at, end_time, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'active')",
         (interaction.guild_id, interaction.channel_id, 标题, 奖品, 中奖人数, 限定身份组.id if 限定身份组 else None, interaction.user.id, datetime.now().isoformat(), end_time.isoformat() if end_time else None))
-    lottery_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    lottery_id = cursor.lastrowid
     desc_lines = [f"🎁 **奖品：**{奖品}", f"🏆 **中奖名额：**{中奖人数} 人"]
     if 限定身份组:
         desc_lines.append(f"🔒 **参与条件：**需要 {限定身份组.mention} 身份组")
@@ -1826,11 +4429,7 @@ async def create_lottery(interaction: discord.Interaction, 标题: str, 奖品:
     embed.set_footer(text="👂 小鹅子祝大家好运～中奖会私信通知哦！")
     view = LotteryJoinView(lottery_id, 限定身份组.id if 限定身份组 else None)
     lottery_msg = await interaction.followup.send(embed=embed, view=view, wait=True)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE lotteries SET message_id = ? WHERE id = ?", (lottery_msg.id, lottery_id))
-    conn.commit()
-    conn.close()
+    await db.execute("UPDATE lotteries SET message_id = ? WHERE id = ?", (lottery_msg.id, lottery_id))
     if duration_delta:
         asyncio.create_task(_lottery_timer(bot, lottery_id, duration_delta.total_seconds()))
 
@@ -1841,11 +4440,7 @@ async def manual_draw(interaction: discord.Interaction, 抽奖编号: int):
         await interaction.response.send_message("👂 这个只有管理员才能用哦～鹅也没办法呀", ephemeral=True)
         return
     await interaction.response.defer(ephemeral=True)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT status, title FROM lotteries WHERE id = ? AND guild_id = ?", (抽奖编号, interaction.guild_id))
-    result = c.fetchone()
-    conn.close()
+    result = await db.fetchone("SELECT status, title FROM lotteries WHERE id = ? AND guild_id = ?", (抽奖编号, interaction.guild_id))
     if not result:
         await interaction.followup.send("👂 找不到这个编号的抽奖呀～", ephemeral=True)
         return
@@ -1867,22 +4462,22 @@ async def cancel_lottery(interaction: discord.Interaction, 抽奖编号: int):
     if not is_admin(interaction):
         await interaction.response.send_message("👂 这个只有管理员才能用哦～鹅也没办法呀", ephemeral=True)
         return
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT status, title, channel_id, message_id FROM lotteries WHERE id = ? AND guild_id = ?", (抽奖编号, interaction.guild_id))
-    result = c.fetchone()
+    def cancel(conn):
+        c = conn.cursor()
+        c.execute("SELECT status, title, channel_id, message_id FROM lotteries WHERE id = ? AND guild_id = ?", (抽奖编号, interaction.guild_id))
+        result = c.fetchone()
+        if result and result[0] == 'active':
+            c.execute("UPDATE lotteries SET status = 'cancelled', ended_at = ? WHERE id = ?", (datetime.now().isoformat(), 抽奖编号))
+        return result
+
+    result = await db.run(cancel)
     if not result:
-        conn.close()
         await interaction.response.send_message("👂 找不到这个编号的抽奖呀～", ephemeral=True)
         return
     if result[0] != 'active':
-        conn.close()
         await interaction.response.send_message(f"👂 抽奖「{result[1]}」已经结束了，不能取消哦～", ephemeral=True)
         return
     title, channel_id, message_id = result[1], result[2], result[3]
-    c.execute("UPDATE lotteries SET status = 'cancelled', ended_at = ? WHERE id = ?", (datetime.now().isoformat(), 抽奖编号))
-    conn.commit()
-    conn.close()
     if message_id:
         try:
             channel = bot.get_channel(channel_id)
@@ -1896,13 +4491,9 @@ async def cancel_lottery(interaction: discord.Interaction, 抽奖编号: int):
 
 @bot.tree.command(name="查看抽奖", description="查看当前服务器进行中的抽奖")
 async def list_lotteries(interaction: discord.Interaction):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""SELECT l.id, l.title, l.prize, l.winner_count, l.end_time, l.channel_id,
+    lotteries = await db.fetchall("""SELECT l.id, l.title, l.prize, l.winner_count, l.end_time, l.channel_id,
                   (SELECT COUNT(*) FROM lottery_entries WHERE lottery_id = l.id) as entry_count
            FROM lotteries l WHERE l.guild_id = ? AND l.status = 'active' ORDER BY l.created_at DESC""", (interaction.guild_id,))
-    lotteries = c.fetchall()
-    conn.close()
     if not lotteries:
         await interaction.response.send_message("👂 目前没有进行中的抽奖哦～", ephemeral=True)
         return
@@ -1937,19 +4528,21 @@ def parse_expire_time(time_str: str):
     return None
 
 
-async def _remove_temp_role(bot_instance, temp_role_id: int):
-    """移除临时身份组"""
-    conn = sqlite3.connect(DB_PATH)
+def end_temp_role(conn, temp_role_id: int, status: str):
+    """把仍然有效的临时身份组标记为结束，返回 (guild_id, user_id, role_id)；已经结束的返回 None"""
     c = conn.cursor()
     c.execute("SELECT guild_id, user_id, role_id FROM temp_roles WHERE id = ? AND status = 'active'", (temp_role_id,))
     result = c.fetchone()
+    if result:
+        c.execute("UPDATE temp_roles SET status = ? WHERE id = ?", (status, temp_role_id))
+    return result
+
+async def _remove_temp_role(bot_instance, temp_role_id: int):
+    """移除临时身份组"""
+    result = await db.run(end_temp_role, temp_role_id, 'expired')
     if not result:
-        conn.close()
         return
     guild_id, user_id, role_id = result
-    c.execute("UPDATE temp_roles SET status = 'expired' WHERE id = ?", (temp_role_id,))
-    conn.commit()
-    conn.close()
     
     try:
         guild = bot_instance.get_guild(guild_id)
@@ -1983,11 +4576,7 @@ async def _remove_temp_role(bot_instance, temp_role_id: int):
 async def _temp_role_timer(bot_instance, temp_role_id: int, delay_seconds: float):
     """等待后自动移除临时身份组"""
     await asyncio.sleep(delay_seconds)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT status FROM temp_roles WHERE id = ?", (temp_role_id,))
-    result = c.fetchone()
-    conn.close()
+    result = await db.fetchone("SELECT status FROM temp_roles WHERE id = ?", (temp_role_id,))
     if result and result[0] == 'active':
         await _remove_temp_role(bot_instance, temp_role_id)
 
@@ -2030,20 +4619,15 @@ async def grant_temp_role(
         await interaction.followup.send(f"👂 添加身份组失败了：{str(e)}\n可能是鹅的权限不够呀", ephemeral=True)
         return
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     try:
-        c.execute(
+        cursor = await db.execute(
             "INSERT OR REPLACE INTO temp_roles (guild_id, user_id, role_id, granted_by, granted_at, expire_at, status) VALUES (?, ?, ?, ?, ?, ?, 'active')",
             (interaction.guild_id, 成员.id, 身份组.id, interaction.user.id, datetime.now().isoformat(), expire_dt.isoformat())
         )
-        temp_role_id = c.lastrowid
-        conn.commit()
+        temp_role_id = cursor.lastrowid
     except Exception as e:
-        conn.close()
         await interaction.followup.send(f"👂 记录失败了：{str(e)}", ephemeral=True)
         return
-    conn.close()
     
     delay = (expire_dt - datetime.now()).total_seconds()
     asyncio.create_task(_temp_role_timer(bot, temp_role_id, delay))
@@ -2065,100 +4649,94 @@ async def list_temp_roles(interaction: discord.Interaction):
         await interaction.response.send_message("👂 这个只有管理员才能用哦～鹅也没办法呀", ephemeral=True)
         return
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "SELECT id, user_id, role_id, expire_at, granted_by FROM temp_roles WHERE guild_id = ? AND status = 'active' ORDER BY expire_at ASC",
-        (interaction.guild_id,)
-    )
-    entries = c.fetchall()
-    conn.close()
-    
-    if not entries:
+    guild = interaction.guild
+
+    async def fetch(after, query, limit):
+        sql = "SELECT id, user_id, role_id, expire_at FROM temp_roles WHERE guild_id = ? AND status = 'active'"
+        params = [guild.id]
+        if after is not None:
+            sql += " AND (expire_at, id) > (?, ?)"
+            params.extend(after)
+        if query:
+            # 按身份组名、用户 ID 或编号搜索
+            conditions = []
+            role_ids = [role.id for role in guild.roles if query.casefold() in role.name.casefold()]
+            if role_ids:
+                conditions.append(f"role_id IN ({', '.join('?' * len(role_ids))})")
+                params.extend(role_ids)
+            number = query.lstrip("#")
+            if number.isdigit():
+                conditions.append("user_id = ? OR id = ?")
+                params.extend([int(number), int(number)])
+            if not conditions:
+                return []
+            sql += f" AND ({' OR '.join(conditions)})"
+        sql += " ORDER BY expire_at, id LIMIT ?"
+        params.append(limit)
+        rows = []
+        for tr_id, user_id, role_id, expire_at in await db.fetchall(sql, params):
+            role = guild.get_role(role_id)
+            role_name = role.name if role else f"未知({role_id})"
+            option = discord.SelectOption(label=f"#{tr_id} - {role_name}", description=f"用户ID: {user_id}", value=str(tr_id))
+            rows.append(((expire_at, tr_id), option, (tr_id, user_id, role_name, expire_at)))
+        return rows
+
+    def render(entries):
+        embed = discord.Embed(title="⏰ 当前临时身份组列表", color=0xffaa00)
+        for _, _, (tr_id, user_id, role_name, expire_at) in entries:
+            try:
+                expire_dt = datetime.fromisoformat(expire_at)
+                unix_ts = int(expire_dt.timestamp())
+                time_str = f"<t:{unix_ts}:R>"
+            except Exception:
+                time_str = expire_at
+
+            embed.add_field(
+                name=f"#{tr_id}",
+                value=f"👤 <@{user_id}> | 🏷️ **{role_name}** | ⏰ {time_str}",
+                inline=False
+            )
+        return embed
+
+    async def remove_selected(select_interaction: discord.Interaction, values):
+        await select_interaction.response.defer(ephemeral=True)
+        removed = []
+        failed = []
+        for tr_id_str in values:
+            tr_id = int(tr_id_str)
+            try:
+                result = await db.run(end_temp_role, tr_id, 'manually_removed')
+                if not result:
+                    continue
+                _, user_id, role_id = result
+                member = guild.get_member(user_id)
+                if not member:
+                    try:
+                        member = await guild.fetch_member(user_id)
+                    except Exception:
+                        member = None
+                role = guild.get_role(role_id)
+                if member and role and role in member.roles:
+                    await member.remove_roles(role, reason="管理员手动提前移除临时身份组")
+                role_name = role.name if role else f"ID:{role_id}"
+                removed.append(f"#{tr_id} {role_name}")
+            except Exception:
+                failed.append(f"#{tr_id}")
+        lines = []
+        if removed:
+            lines.append(f"👂 已移除：{'、'.join(removed)}")
+        if failed:
+            lines.append(f"⚠️ 移除失败：{'、'.join(failed)}")
+        await select_interaction.followup.send("\n".join(lines) if lines else "👂 没有变化", ephemeral=True)
+
+    view = PagedSelectView(fetch, remove_selected, "👂 选择要提前移除的...", timeout=180, max_values=10, render=render)
+    await view.load()
+    if not view.entries:
         await interaction.response.send_message("👂 目前没有临时身份组哦～", ephemeral=True)
         return
-    
+
     await interaction.response.defer(ephemeral=True)
-    guild = interaction.guild
-    
-    embed = discord.Embed(title="⏰ 当前临时身份组列表", color=0xffaa00)
-    select_options = []
-    
-    for tr_id, user_id, role_id, expire_at, granted_by in entries:
-        role = guild.get_role(role_id)
-        role_name = role.name if role else f"未知({role_id})"
-        try:
-            expire_dt = datetime.fromisoformat(expire_at)
-            unix_ts = int(expire_dt.timestamp())
-            time_str = f"<t:{unix_ts}:R>"
-        except Exception:
-            time_str = expire_at
-        
-        embed.add_field(
-            name=f"#{tr_id}",
-            value=f"👤 <@{user_id}> | 🏷️ **{role_name}** | ⏰ {time_str}",
-            inline=False
-        )
-        if len(select_options) < 25:
-            select_options.append(
-                discord.SelectOption(
-                    label=f"#{tr_id} - {role_name}",
-                    description=f"用户ID: {user_id}",
-                    value=str(tr_id)
-                )
-            )
-    
-    class TempRoleRemoveView(discord.ui.View):
-        def __init__(self):
-            super().__init__(timeout=180)
-            self.select = discord.ui.Select(
-                placeholder="👂 选择要提前移除的...",
-                options=select_options,
-                min_values=1,
-                max_values=min(len(select_options), 10),
-            )
-            self.select.callback = self.remove_selected
-            self.add_item(self.select)
-        
-        async def remove_selected(self, select_interaction: discord.Interaction):
-            await select_interaction.response.defer(ephemeral=True)
-            removed = []
-            failed = []
-            for tr_id_str in self.select.values:
-                tr_id = int(tr_id_str)
-                try:
-                    conn = sqlite3.connect(DB_PATH)
-                    c = conn.cursor()
-                    c.execute("SELECT user_id, role_id FROM temp_roles WHERE id = ? AND status = 'active'", (tr_id,))
-                    result = c.fetchone()
-                    if not result:
-                        conn.close()
-                        continue
-                    user_id, role_id = result
-                    c.execute("UPDATE temp_roles SET status = 'manually_removed' WHERE id = ?", (tr_id,))
-                    conn.commit()
-                    conn.close()
-                    member = guild.get_member(user_id)
-                    if not member:
-                        try:
-                            member = await guild.fetch_member(user_id)
-                        except Exception:
-                            member = None
-                    role = guild.get_role(role_id)
-                    if member and role and role in member.roles:
-                        await member.remove_roles(role, reason="管理员手动提前移除临时身份组")
-                    role_name = role.name if role else f"ID:{role_id}"
-                    removed.append(f"#{tr_id} {role_name}")
-                except Exception:
-                    failed.append(f"#{tr_id}")
-            lines = []
-            if removed:
-                lines.append(f"👂 已移除：{'、'.join(removed)}")
-            if failed:
-                lines.append(f"⚠️ 移除失败：{'、'.join(failed)}")
-            await select_interaction.followup.send("\n".join(lines) if lines else "👂 没有变化", ephemeral=True)
-    
-    await interaction.followup.send(embed=embed, view=TempRoleRemoveView(), ephemeral=True)
+    await interaction.followup.send(**view.message_kwargs(), ephemeral=True)
 
 
 # ============ 管理员：批量删除消息 ============
@@ -2299,4 +4877,16 @@ async def bulk_delete(
     await interaction.followup.send("\n".join(result_parts), ephemeral=True)
 
 # ============ 启动 Bot ============
-bot.run(BOT_TOKEN)
+def handle_sigterm(signum, frame):
+    """平台重启 worker 时发的是 SIGTERM：按 Ctrl+C 处理，让 bot.run 正常退出，下面的 finally 把写缓冲提交落盘"""
+    raise KeyboardInterrupt
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    load_anon_channels()
+    watermark.start()
+    try:
+        bot.run(BOT_TOKEN)
+    finally:
+        watermark.shutdown()
+        db.close()